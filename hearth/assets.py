@@ -0,0 +1,139 @@
+"""Static assets, held in memory with compressed variants."""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LOGGER = logging.getLogger(__name__)
+
+COMPRESSIBLE = ('.html', '.js', '.css', '.json', '.txt', '.map', '.svg', '.ttf', '.eot')
+CHECK_INTERVAL = 2
+CSS_URL = re.compile(r'url\((\./)?([^)?#:]+)\)')
+HTML_URL = re.compile(r'(href|src)="static/([^"?#]+)"')
+
+
+def _read(path):
+    """Read file, if it exists."""
+    try:
+        with open(path, 'rb') as ifile:
+            return ifile.read()
+    except OSError:
+        return None
+
+
+class Asset:  # pylint: disable=too-few-public-methods
+    """File held in memory.
+
+    Compressed variants are read from `.gz`/`.br` files next to it when they
+    are up to date, and built otherwise. Brotli needs the optional brotli
+    module."""
+
+    def __init__(self, path, body, deps=None):
+        self.mtime = os.stat(path).st_mtime
+        self.checked = time.monotonic()
+        self.body = body
+        self.deps = deps or {}
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.variants = {}
+        if not path.endswith(COMPRESSIBLE):
+            return
+        for encoding, suffix, compress in (
+                ('br', '.br', brotli.compress if brotli else None),
+                ('gzip', '.gz', lambda data: gzip.compress(data, 9))):
+            prebuilt = None
+            if not self.deps and os.path.exists(path + suffix) \
+                    and os.stat(path + suffix).st_mtime >= self.mtime:
+                prebuilt = _read(path + suffix)
+            if prebuilt is not None:
+                self.variants[encoding] = prebuilt
+            elif compress is not None:
+                self.variants[encoding] = compress(body)
+
+    def encoded(self, accept_encoding):
+        """Body and content encoding, for an Accept-Encoding header."""
+        accepted = {encoding.split(';')[0].strip() for encoding in accept_encoding.split(',')}
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.variants:
+                return self.variants[encoding], encoding
+        return self.body, None
+
+
+class Assets:
+    """Static files under a directory, loaded on first request and reloaded
+    when they, or the files they reference, change.
+
+    URLs to other assets in HTML and CSS files are fingerprinted with the
+    `?v=` content hash of the referenced file, so these can be cached
+    forever."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.cache = {}
+
+    def path(self, name):
+        """Path of asset, or None if outside of the root."""
+        path = os.path.normpath(os.path.join(self.root, name))
+        return path if path.startswith(self.root + os.sep) else None
+
+    def get(self, name):
+        """Get asset, or None if there is no such file."""
+        asset = self.cache.get(name)
+        if asset is not None and time.monotonic() - asset.checked < CHECK_INTERVAL:
+            return asset
+        path = self.path(name)
+        if path is None or not os.path.isfile(path):
+            self.cache.pop(name, None)
+            return None
+        if asset is not None and asset.mtime == os.stat(path).st_mtime and all(
+                self.etag(dep) == etag for dep, etag in asset.deps.items()):
+            asset.checked = time.monotonic()
+            return asset
+        asset = self.load(name, path)
+        self.cache[name] = asset
+        return asset
+
+    def etag(self, name):
+        """Content hash of asset."""
+        asset = self.get(name)
+        return asset.etag if asset else None
+
+    def load(self, name, path):
+        """Read asset, fingerprinting references to other assets."""
+        body = _read(path)
+        deps = {}
+
+        def fingerprint(prefix, ref, suffix):
+            """Reference with content hash."""
+            dep = os.path.normpath(os.path.join(os.path.dirname(name), ref))
+            etag = self.etag(dep) if self.path(dep) else None
+            if etag is None:
+                return prefix + ref + suffix
+            deps[dep] = etag
+            return f"{prefix}{ref}?v={etag}{suffix}"
+
+        if name.endswith('.css'):
+            body = CSS_URL.sub(lambda match: fingerprint(
+                "url(" + (match.group(1) or ""), match.group(2), ")"), body.decode()).encode()
+        elif name.endswith('.html'):
+            body = HTML_URL.sub(lambda match: fingerprint(
+                f'{match.group(1)}="static/', match.group(2), '"'), body.decode()).encode()
+        LOGGER.debug("Loaded asset: %s", name)
+        return Asset(path, body, deps)
+
+    def preload(self):
+        """Load and compress all assets."""
+        started = time.monotonic()
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith(('.gz', '.br')):
+                    self.get(os.path.relpath(os.path.join(dirpath, filename), self.root))
+        LOGGER.info("Loaded %d assets in %.1f s", len(self.cache), time.monotonic() - started)
@@ -0,0 +1,74 @@
+"""JSON codec, using orjson or ujson when available.
+
+`dumps` encodes to str, `dumpb` to bytes, and `loads` decodes either. Decode
+errors are raised as ValueError with every backend."""
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+LOGGER = logging.getLogger(__name__)
+
+BACKEND = None
+
+
+def _json_dumps(obj):
+    """Encode with the standard library."""
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _json_dumpb(obj):
+    """Encode with the standard library, to bytes."""
+    return _json_dumps(obj).encode()
+
+
+def _orjson_dumpb(obj):
+    """Encode with orjson, to bytes."""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _orjson_dumps(obj):
+    """Encode with orjson."""
+    return _orjson_dumpb(obj).decode()
+
+
+def _ujson_dumps(obj):
+    """Encode with ujson."""
+    return ujson.dumps(obj, escape_forward_slashes=False)
+
+
+def _ujson_dumpb(obj):
+    """Encode with ujson, to bytes."""
+    return _ujson_dumps(obj).encode()
+
+
+def available():
+    """Names of the installed backends, fastest first."""
+    return ([name for name, module in (('orjson', orjson), ('ujson', ujson)) if module]
+            + ['json'])
+
+
+def use(backend=None):
+    """Select backend by name, or the fastest available one."""
+    global BACKEND, dumps, dumpb, loads  # pylint: disable=global-statement,invalid-name
+    backend = backend or available()[0]
+    if backend not in available():
+        raise ValueError(f"JSON backend not available: {backend}")
+    BACKEND = backend
+    dumps, dumpb, loads = {
+        'orjson': lambda: (_orjson_dumps, _orjson_dumpb, orjson.loads),
+        'ujson': lambda: (_ujson_dumps, _ujson_dumpb, ujson.loads),
+        'json': lambda: (_json_dumps, _json_dumpb, json.loads),
+    }[backend]()
+    LOGGER.debug("Using JSON backend: %s", backend)
+
+
+dumps = dumpb = loads = None  # pylint: disable=invalid-name
+use()
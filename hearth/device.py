@@ -1,59 +1,153 @@
 """Device base class."""
 import os
 import asyncio
-from copy import deepcopy
 from datetime import datetime
 import inspect
-import json
+from itertools import islice
 import logging
+import math
+from urllib.parse import quote
 from asyncinit import asyncinit
+from . import codec
 from . import hearth
 from . import web
+from .events import EventRouter, split
+from .history import History, Retention, TIMEFORMAT
 
 LOGGER = logging.getLogger(__name__)
+WEBMESSAGES = ('get_devices', 'subscribe', 'unsubscribe', 'batch', 'get_quick_actions')
+
+
+def splice(old, new):
+    """Express list `new` as `old` with `drop` items removed from the head,
+    `trim` from the tail and `append` added, or None if they do not overlap."""
+    if not old or not new:
+        return None
+    try:
+        drop = old.index(new[0])
+    except ValueError:
+        return None
+    keep = 0
+    for old_item, new_item in zip(islice(old, drop, None), new):
+        if old_item != new_item:
+            break
+        keep += 1
+    return {"drop": drop, "trim": len(old) - drop - keep, "append": new[keep:]}
+
+
+def plotvalue(value):
+    """Value as a number to plot, or None if it is not one."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
 
 
 @asyncinit
 class Device:
     """Device base class."""
 
+    retention = Retention()
+
     async def __init__(self, id_, mapping=None):
         self.id = id_  # pylint: disable=invalid-name
         self.mapping = mapping
         self._update_fut = None
         self.state = {'reachable': False,
                       'last_seen': ''}
-        self._eventlisteners = {}
-        self.history = []
+        self._events = EventRouter()
+        self.state_version = 0
+        self._serialized = (None, None)
+        self._sent = None
+        self._sent_json = (None, None)
+        self.history = History(self.history_dirname(), self.retention)
         await self.load_history()
 
     def history_filename(self):
-        """Get path to device state history."""
+        """Get path to legacy single-file device state history."""
         filename = "".join(x for x in str(self.id) if x.isalnum())
         return os.path.abspath(".cache/" + filename)
 
+    def history_dirname(self):
+        """Get path to device state history log."""
+        filename = "".join(x for x in str(self.id) if x.isalnum())
+        return os.path.abspath(".cache/history/" + filename)
+
     async def load_history(self):
-        """Load history from file."""
-        self.history = []
-        hfile = self.history_filename()
+        """Restore last known state. The full history is loaded on first
+        access."""
         try:
-            if os.path.exists(hfile):
-                with open(hfile, 'r') as ifile:
-                    self.history = json.load(ifile)
-            if self.history and isinstance(self.history, list):
-                self.state = self.history[-1][1]
+            self.migrate_history()
+            state = self.history.load()
+            if state:
+                self.state = state
         except Exception as e:  # pylint: disable=broad-except, invalid-name
             LOGGER.warning("Could not load history: %s", self.id)
             LOGGER.error(e)
 
-    async def save_history(self):
-        """Save history to file."""
+    def migrate_history(self):
+        """Move legacy single-file history into the history log."""
         hfile = self.history_filename()
-        hdir = os.path.dirname(hfile)
-        if not os.path.exists(hdir):
-            os.makedirs(hdir)
-        with open(hfile, 'w') as ofile:
-            json.dump(self.history, ofile)
+        if not os.path.isfile(hfile) or self.history.log.exists():
+            return
+        with open(hfile, 'rb') as ifile:
+            history = codec.loads(ifile.read())
+        migrated = History(self.history_dirname())
+        for timestamp, upd_state in history if isinstance(history, list) else []:
+            migrated.append(timestamp, upd_state)
+        migrated.flush()
+        os.remove(hfile)
+        LOGGER.info("Migrated history: %s", self.id)
+
+    async def save_history(self):
+        """Flush pending history to file."""
+        await self.history.aflush()
+
+    def history_range(self, start=None, end=None, keys=None):
+        """Get a lazy view of the state history between two timestamps."""
+        return self.history.history_range(start, end, keys)
+
+    def plotdata(self, key, start, end=None, points=None, yname='y', divisor=1.0):
+        """Plot points of a state key between two timestamps, at most `points`
+        of them. Tracked numeric keys are plotted sample by sample, in epoch
+        milliseconds, and other keys as steps between their changes. Values
+        that are not numbers are left out."""
+        view = self.history_range(start, end)
+        if key in self.history.series:
+            times, values = view.series(key)
+            data = [{'x': int(t * 1000), yname: v / divisor}
+                    for t, v in zip(times, values) if v == v]
+        else:
+            data = []
+            for t, s in view.changes(key):
+                value = plotvalue(s)
+                if value is None:
+                    continue
+                if data:
+                    data.append({'x': t, yname: data[-1][yname]})
+                data.append({'x': t, yname: value})
+            current = plotvalue(self.state.get(key))
+            if end is None and (current is not None or data):
+                data.append({'x': datetime.now().strftime(TIMEFORMAT),
+                             yname: current if current is not None else data[-1][yname]})
+            elif end is not None and data:
+                data.append({'x': end, yname: data[-1][yname]})
+        if points and len(data) > points:
+            step = math.ceil(len(data) / points)
+            data = data[::step] + data[-1:] if (len(data) - 1) % step else data[::step]
+        return data
+
+    def plotsource(self, key, hours=1):
+        """URL of plot data of a state key, for the last few hours."""
+        return f"/h/{quote(str(self.id))}/{quote(key)}?hours={hours}"
+
+    def record_history(self, upd_state):
+        """Append state change to history."""
+        self.history.append(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), upd_state)
 
     async def shutdown(self):
         """Shutdown procedure."""
@@ -63,7 +157,7 @@ class Device:
         """Create a websocket message."""
         data = data or {}
         data.update({"id": self.id})
-        return json.dumps(data)
+        return codec.dumps(data)
 
     def listen(self, eventname, callback=None):
         """Register event listener."""
@@ -71,17 +165,13 @@ class Device:
             for ename, ecb in eventname.items():
                 self.listen(ename, ecb)
         elif callback is not None:
-            if eventname not in self._eventlisteners:
-                self._eventlisteners[eventname] = []
-            self._eventlisteners[eventname].append(callback)
+            self._events.listen(eventname, callback)
+            self.state_version += 1
+            self.refresh_ui()
 
     def event(self, eventname, *args, **kwargs):
         """Announce event."""
-        for callback in self._eventlisteners.get(eventname, []):
-            nargs = len(inspect.signature(callback).parameters) - len(kwargs)
-            res = callback(*args[:nargs], **kwargs)
-            if inspect.isawaitable(res):
-                asyncio.ensure_future(res)
+        self._events.emit(split(eventname), args, kwargs)
 
     async def set_state(self, upd_state):
         """Set new state. This may be overridden to command device to set the
@@ -103,7 +193,9 @@ class Device:
 
         if upd_state:
             self.state.update(upd_state)
-            self.history.append([datetime.now().strftime("%Y-%m-%d %H:%M:%S"), deepcopy(upd_state)])
+            self.state_version += 1
+            self.record_history(upd_state)
+            self.refresh_ui()
 
     async def update_state(self, upd_state, set_seen=True):
         """Update the state. This is mainly called when the device informs of a
@@ -125,19 +217,29 @@ class Device:
         if set_seen:
             upd_state.update({'reachable': True})
             upd_state.update({'last_seen': datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
-        old_state = deepcopy(self.state)
+        old_state = {key: self.state.get(key) for key in upd_state}
         self.state.update(upd_state)
-        self.history.append([datetime.now().strftime("%Y-%m-%d %H:%M:%S"), deepcopy(self.state)])
+        self.state_version += 1
+        self.record_history(self.state)
         self.refresh_ui()
         self.event('statechange', self)
-        for key in actually_updated:
-            self.event(f'statechange:{key}', self.state[key], old_state.get(key, None), key, self)
-            self.event(f'statechange:{key}:{self.state[key]}',
-                       self.state[key], old_state.get(key, None), key, self)
-        for key in upd_state:
-            self.event(f'stateupdate:{key}', self.state[key], old_state.get(key, None), key, self)
-            self.event(f'stateupdate:{key}:{self.state[key]}',
-                       self.state[key], old_state.get(key, None), key, self)
+        self.announce('statechange', actually_updated, old_state)
+        self.announce('stateupdate', upd_state, old_state)
+
+    def announce(self, eventname, keys, old_state):
+        """Announce `eventname:key` and `eventname:key:value` for each key,
+        formatting only the names someone listens to."""
+        events = self._events
+        if not events.expects(eventname):
+            return
+        for key in keys:
+            nodes = events.match((eventname, key))
+            if not nodes:
+                continue
+            args = (self.state[key], old_state.get(key, None), key, self)
+            events.dispatch(nodes, args)
+            if any(node.children for node in nodes):
+                events.emit((eventname, key, f'{self.state[key]}'), args)
 
     def expect_update(self, timeout):
         """Ensure update is called within a given timeout."""
@@ -169,13 +271,82 @@ class Device:
         return active_alerts
 
     def serialize(self):  # pylint: disable=no-self-use
-        """React."""
+        """React. Cached until the state version changes, so ui() is computed
+        once per version."""
+        version, data = self._serialized
+        if version == self.state_version:
+            return data
         state = self.state.copy()
         ui_ = self.ui()
         if ui_ and 'state' in ui_:  # pylint: disable=unsupported-membership-test
             state.update(ui_['state'])  # pylint: disable=unsubscriptable-object
         state.update({'alerts': self.alerts()})
-        return {'id': self.id, 'state': state, 'ui': ui_}
+        data = {'id': self.id, 'state': state, 'ui': ui_}
+        self._serialized = (self.state_version, data)
+        return data
+
+    def frame(self):
+        """Serialize into state and UI schema, for the delta protocol."""
+        data = self.serialize()
+        ui_ = data['ui']
+        if isinstance(ui_, dict) and 'state' in ui_:
+            ui_ = {key: value for key, value in ui_.items() if key != 'state'}
+        return data['state'], ui_
+
+    def snapshot(self):
+        """Full serialization as last sent to clients, which following patches
+        apply to."""
+        if self._sent is None:
+            state, ui_ = self.frame()
+            self._sent = {'id': self.id, 'v': 1, 'state': state, 'ui': ui_, 'uiv': 1}
+        return self._sent
+
+    def reset_snapshot(self):
+        """Forget the sent serialization, when nobody follows the device."""
+        self._sent = None
+
+    def snapshot_json(self):
+        """JSON encoded snapshot, cached per sent version."""
+        sent = self.snapshot()
+        version, encoded = self._sent_json
+        if version != sent['v']:
+            encoded = codec.dumps(sent)
+            self._sent_json = (sent['v'], encoded)
+        return encoded
+
+    def patch(self):
+        """Advance the sent serialization. Returns a patch from the previous
+        one, or None if nothing changed or nobody has a snapshot."""
+        sent = self._sent
+        if sent is None:
+            return None
+        state, ui_ = self.frame()
+        old = sent['state']
+        changed = {}
+        lists = {}
+        for key, value in state.items():
+            if key in old and old[key] == value:
+                continue
+            if isinstance(value, list) and isinstance(old.get(key), list):
+                spliced = splice(old[key], value)
+                if spliced is not None:
+                    lists[key] = spliced
+                    continue
+            changed[key] = value
+        removed = [key for key in old if key not in state]
+        msg = {}
+        if ui_ != sent['ui']:
+            sent['uiv'] += 1
+            msg.update({'ui': ui_, 'uiv': sent['uiv']})
+        if not (changed or lists or removed or msg):
+            return None
+        msg.update({'m': 'patch', 'base': sent['v'], 'v': sent['v'] + 1, 'state': changed})
+        if lists:
+            msg['lists'] = lists
+        if removed:
+            msg['remove'] = removed
+        sent.update({'v': msg['v'], 'state': state, 'ui': ui_})
+        return msg
 
     def quick_actions(self):
         return []
@@ -187,8 +358,9 @@ class Device:
     def events_ui(self):
         """Return UI for triggering events."""
         events = [event
-                  for event, listeners in self._eventlisteners.items()
-                  if len(listeners) > 0 and len(inspect.signature(listeners[0]).parameters) == 0]
+                  for event, listeners in self._events.names.items()
+                  if len(listeners) > 0 and listeners[0].nargs == 0
+                  and '*' not in split(event)]
         if not events:
             return []
         return [
@@ -197,22 +369,28 @@ class Device:
              "action": "event",
              "items": events}]
 
+    def handles(self, method):
+        """Check if `method` can be called through the webhandler."""
+        return (isinstance(method, str) and not method.startswith('_')
+                and callable(getattr(self, method, None)))
+
     async def webhandler(self, data, _):
-        """Default webhandler."""
-        if 'm' in data and not data['m'].startswith('_'):
+        """Default webhandler. Returns the result of the called method."""
+        if self.handles(data.get('m')):
             LOGGER.info("Got webmessage: %s", data)
-            fun = getattr(self, data['m'], None)
-            if callable(fun):
-                args = data.get('args', [])
-                LOGGER.info("Executing: %s, %s", data, fun)
-                res = fun(*args)
-                if inspect.isawaitable(res):
-                    await res
+            fun = getattr(self, data['m'])
+            args = data.get('args', [])
+            LOGGER.info("Executing: %s, %s", data, fun)
+            res = fun(*args)
+            if inspect.isawaitable(res):
+                res = await res
+            return res
+        return None
 
     def refresh_ui(self):
-        """Announce state changes."""
-        LOGGER.info("Refreshing UI: %s", self.id)
-        web.broadcast(self.webmessage(self.serialize()))
+        """Announce state changes. The UI is serialized and broadcast once per
+        frame, however many times this is called in between."""
+        web.refresh(self)
         self.event('refresh_ui')
 
     def __getitem__(self, key):
@@ -227,22 +405,42 @@ class HearthDevice(Device):
         await super().__init__(0)
         await super().update_state({})
 
+    def handles(self, method):
+        """Check if `method` can be sent to the webhandler."""
+        return method in WEBMESSAGES or super().handles(method)
+
     async def webhandler(self, data, socket):
         """Handle incoming message."""
         if data['m'] == 'get_devices':
-            await socket.send(self.webmessage(
-                {"m": "devices",
-                 "devices": [d.serialize()
-                             for d in hearth.DEVICES.values()]}))
+            web.flush()
+            await self.send_devices(socket, data.get('devices') or hearth.DEVICES.keys())
+        elif data['m'] in ('subscribe', 'unsubscribe'):
+            ids = data.get('devices', "all")
+            if data['m'] == 'unsubscribe':
+                web.unsubscribe(socket, ids)
+                return
+            web.flush()
+            ids = web.subscribe(socket, ids)
+            if ids:
+                await self.send_devices(socket, ids)
+        elif data['m'] == 'batch':
+            results = await web.batch(data.get('ops', []), socket, data.get('ordered', False))
+            await socket.send({"m": "batch", "ref": data.get('ref'), "results": results,
+                               "id": self.id})
         elif data['m'] == 'get_quick_actions':
-            await socket.send(self.webmessage(
-                {"m": "quick_actions",
-                 "quick_actions": [x
-                                   for d in hearth.DEVICES.values()
-                                   for x in d.quick_actions()]}))
+            await socket.send({"m": "quick_actions",
+                               "quick_actions": [x
+                                                 for d in hearth.DEVICES.values()
+                                                 for x in d.quick_actions()],
+                               "id": self.id})
         else:
             await super().webhandler(data, socket)
 
+    async def send_devices(self, socket, ids):  # pylint: disable=no-self-use
+        """Send device snapshots."""
+        devices = [hearth.DEVICES[id_] for id_ in ids if id_ in hearth.DEVICES]
+        await socket.send(lambda binary: web.devices_message(devices, binary))
+
     def ui(self):
         """UI."""
         return {"ui": self.events_ui()}
@@ -37,3 +37,4 @@ class Chromecast(Device):
     async def shutdown(self):
         """Shut down."""
         await self.session.__aexit__(None, None, None)
+        await super().shutdown()
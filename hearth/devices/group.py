@@ -31,7 +31,7 @@ class Group(Device):
         ] if inspect.isawaitable(x)))
 
     def __getattribute__(self, attr):
-        if attr in ['state', 'ui']:
+        if attr in ['state', 'state_version', 'ui']:
             return getattr(self.devices[0], attr)
         elif attr in ['set_state', 'set_single_state']:
             return functools.partial(self.broadcast, attr)
@@ -2,8 +2,7 @@
 import asyncio
 import logging
 from datetime import datetime, timedelta
-import json
-from hearth import Device, mqtt
+from hearth import Device, codec, mqtt
 
 __all__ = ['MqttBlinds']
 WAIT_TIME = 10
@@ -19,15 +18,25 @@ class MqttBlinds(Device):
         self.name = name
         self.mqtt = await mqtt.server()
         await super().init_state({'level': False})
-        await self.mqtt.sub(f"{self.name}/state", self.mqtt_update_state)
-        asyncio.ensure_future(self.ping())
+        topic = f"{self.name}/state"
+        await self.mqtt.sub(topic, self.mqtt_update_state,
+                            via=None if '/' in self.name else "+/state")
+        retained = self.mqtt.retained.get(topic)
+        if retained is not None:
+            try:
+                await self.mqtt_update_state(topic, retained, set_seen=False)
+            except ValueError:
+                LOGGER.warning("%s: Invalid retained state: %s", self.name, retained)
+                retained = None
+        asyncio.ensure_future(self.ping(0 if retained is None else WAIT_TIME))
 
-    async def mqtt_update_state(self, _, payload):
+    async def mqtt_update_state(self, _, payload, set_seen=True):
         """Update state from mqtt data."""
-        await self.update_state(json.loads(payload))
+        await self.update_state(codec.loads(payload), set_seen)
 
-    async def ping(self):
+    async def ping(self, delay=0):
         """Periodically retrieve status to check connection is live."""
+        await asyncio.sleep(delay)
         while True:
             self.expect_update(WAIT_TIME)
             await self.mqtt.pub(f"{self.name}/send_state", "")
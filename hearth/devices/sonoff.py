@@ -1,7 +1,6 @@
 """SonOff device classes."""
 import asyncio
 import logging
-from datetime import datetime, timedelta
 from hearth import Device, mqtt
 
 __all__ = ['SonOff']
@@ -18,11 +17,17 @@ class SonOff(Device):
         self.name = name
         self.mqtt = await mqtt.server()
         await super().init_state({'on': False})
-        await self.mqtt.sub(f"stat/{self.name}/POWER", self.update_power_state)
-        asyncio.ensure_future(self.ping())
+        topic = f"stat/{self.name}/POWER"
+        await self.mqtt.sub(topic, self.update_power_state,
+                            via=None if '/' in self.name else "stat/+/POWER")
+        retained = self.mqtt.retained.get(topic)
+        if retained is not None:
+            await self.update_power_state(topic, retained, set_seen=False)
+        asyncio.ensure_future(self.ping(0 if retained is None else WAIT_TIME))
 
-    async def ping(self):
+    async def ping(self, delay=0):
         """Periodically retrieve status to check connection is live."""
+        await asyncio.sleep(delay)
         while True:
             self.expect_update(WAIT_TIME)
             await self.mqtt.pub(f"cmnd/{self.name}/power", "")
@@ -53,34 +58,13 @@ class SonOff(Device):
         else:
             await super().set_state(upd_state)
 
-    async def update_power_state(self, _, payload):
+    async def update_power_state(self, _, payload, set_seen=True):
         """Update power state."""
         LOGGER.debug("%s: New power state: %s", self.name, payload)
-        await self.update_state({'on': (payload == "ON")})
+        await self.update_state({'on': (payload == "ON")}, set_seen)
 
     def ui(self):
         """Return jsx ui representation."""
-        onoffdata = []
-        t = tprev = str(datetime.now()).split('.')[0]
-        sprev = self.state['on']
-        lstart = (tprev, int(sprev))
-        lasttime = str(datetime.now() - timedelta(hours=1)).split('.')[0]
-        for t, s, in reversed(self.history):
-            t = t.partition('.')[0]
-            if sprev != s['on']:
-                onoffdata.append({'x': lstart[0], 'y': lstart[1]})
-                onoffdata.append({'x': tprev, 'y': lstart[1]})
-                lstart = (tprev, int(s['on']))
-            tprev = t
-            sprev = s['on']
-            if t < lasttime:
-                t = lasttime
-                break
-        onoffdata.append({'x': lstart[0], 'y': lstart[1]})
-        if t != tprev:
-            onoffdata.append({'x': t, 'y': lstart[1]})
-        onoffdata.reverse()
-
         return {"rightIcon": "indeterminate_check_box",
                 "rightAction": "toggle",
                 "ui": [
@@ -88,7 +72,7 @@ class SonOff(Device):
                      "props": {"label": "On"},
                      "state": "on"},
                     {"class": "C3Chart",
-                     "state": "onoffdata",
+                     "source": self.plotsource('on'),
                      "props": {
                          "data": {
                              "keys": {"x": "x", "value": ["y"]},
@@ -111,5 +95,4 @@ class SonOff(Device):
                          }
                      }
                     }
-                ],
-                "state": {"onoffdata": onoffdata}}
+                ]}
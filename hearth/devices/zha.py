@@ -52,19 +52,21 @@ class ZHAWeather(ZHASensor):
 class ZHAContact(ZHASensor):
     """Zigbee window/door sensor."""
 
+    discrete = True
+
     async def __init__(self, *args, **kwargs):
         """Init."""
         await super().__init__('contact', *args, **kwargs)
-        self.discrete = True
 
 
 class ZHAPresence(ZHASensor):
     """Zigbee window/door sensor."""
 
+    discrete = True
+
     async def __init__(self, *args, **kwargs):
         """Init."""
         await super().__init__('occupancy', *args, **kwargs)
-        self.discrete = True
 
 
 class ZHASwitch(ZDevice):
@@ -1,8 +1,7 @@
-import json
 import logging
 import hearth
 from hearth.device import Device as DeviceBase
-from hearth import mqtt
+from hearth import codec, mqtt
 
 LOGGER = logging.getLogger(__name__)
 
@@ -21,12 +20,14 @@ class ZigbeeController(DeviceBase):
     async def onoffline(self, _, payload):
         LOGGER.info("Getting zigbee update: %s :: %s", self.id, payload)
         self.state['online'] = (payload == 'online')
+        self.state_version += 1
+        self.refresh_ui()
 
     async def updatehandler(self, _, payload):
         """Handle update message from MQTT."""
         LOGGER.info("Getting zigbee update: %s :: %s", self.id, payload)
         try:
-            await self.update_state(json.loads(payload))
+            await self.update_state(codec.loads(payload))
         except:
             LOGGER.warning("Failed to parse MQTT message: %s", payload)
 
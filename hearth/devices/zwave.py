@@ -1,10 +1,9 @@
 """ZWave device classes."""
 import asyncio
-import json
 import logging
 import hearth
 from hearth.sensor import Sensor
-from hearth import Device, mqtt
+from hearth import Device, codec, mqtt
 
 __all__ = ['ZWThermostat', 'ZWSwitch', 'ZWDimmer',
            'ZWContact']  # , 'ZWSwitchDimmer']
@@ -24,12 +23,14 @@ class ZWDevice(Device):
         self.zwstates = {}
         self.zwstates_inv = {}
         self.basetopic = f"{mqtt_prefix}/{self.zwid}"
-        await self.mqtt.sub(f"{self.basetopic}/status", self.statushandler)
+        await self.mqtt.sub(f"{self.basetopic}/status", self.statushandler,
+                            via=f"{self.basetopic}/#")
 
     async def subscribe(self):
         self.zwstates_inv = {y: x for x, y in self.zwstates.items()}
         await asyncio.gather(*[
-            self.mqtt.sub(f"{self.basetopic}/{key}", self.updatehandler)
+            self.mqtt.sub(f"{self.basetopic}/{key}", self.updatehandler,
+                          via=f"{self.basetopic}/#")
             for key in self.zwstates.values()])
 
     async def updatehandler(self, topic, payload):
@@ -40,7 +41,7 @@ class ZWDevice(Device):
             LOGGER.info("Invalid topic: %s: %s", topic, payload)
             return
         try:
-            data = json.loads(payload)
+            data = codec.loads(payload)
             LOGGER.info("Updating from zwave: %s: %s", state, data)
             await self.update_state({state: data.get("value")})
         except Exception as e:
@@ -51,7 +52,7 @@ class ZWDevice(Device):
         """Handle updatemessage from MQTT."""
         LOGGER.info("Getting zwave update: %s :: %s", self.zwid, payload)
         try:
-            data = json.loads(payload)
+            data = codec.loads(payload)
             await self.update_state({"ready": data["value"], "status": data["status"]})
         except:
             LOGGER.warning("Failed to parse MQTT status message: %s", payload)
@@ -174,6 +175,8 @@ class ZWDimmer(ZWDevice):
         self.state["switch"] = (self.state["level"] > 0.01)
         if self.state["level"] > 0:
             self.state["resumelevel"] = self.state["level"]
+        self.state_version += 1
+        self.refresh_ui()
 
     async def update_state(self, upd_state, set_seen=True):
         if "level" in upd_state:
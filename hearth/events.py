@@ -0,0 +1,79 @@
+"""Event routing."""
+import asyncio
+from collections import namedtuple
+import inspect
+
+Listener = namedtuple('Listener', ['callback', 'nargs', 'is_async'])
+
+
+def make_listener(callback):
+    """Resolve arity and async-ness of an event callback once."""
+    return Listener(callback,
+                    len(inspect.signature(callback).parameters),
+                    inspect.iscoroutinefunction(callback))
+
+
+def split(eventname):
+    """Split event name into at most three parts: event, key and value."""
+    return tuple(eventname.split(':', 2))
+
+
+class Node:  # pylint: disable=too-few-public-methods
+    """Event name trie node."""
+    __slots__ = ('children', 'listeners')
+
+    def __init__(self):
+        self.children = {}
+        self.listeners = []
+
+
+class EventRouter:
+    """Index of event listeners.
+
+    Event names are split on ':' into at most three parts, as in
+    `statechange:temperature:21`. A `*` part in a listened-to name matches any
+    part in that position. Listeners are kept in a trie of name parts, so it
+    can be checked whether anything listens to an event, or to any event
+    starting with some parts, before the rest of its name is formatted."""
+
+    def __init__(self):
+        self.names = {}
+        self.root = Node()
+
+    def listen(self, eventname, callback):
+        """Register event listener."""
+        listener = make_listener(callback)
+        self.names.setdefault(eventname, []).append(listener)
+        node = self.root
+        for part in split(eventname):
+            node = node.children.setdefault(part, Node())
+        node.listeners.append(listener)
+
+    def match(self, parts):
+        """Get trie nodes matching event name parts."""
+        nodes = [self.root]
+        for part in parts:
+            nodes = [child for node in nodes
+                     for child in (node.children.get(part), node.children.get('*'))
+                     if child is not None]
+            if not nodes:
+                break
+        return nodes
+
+    def expects(self, *parts):
+        """Check if any listener matches an event starting with `parts`."""
+        return bool(self.match(parts))
+
+    @staticmethod
+    def dispatch(nodes, args, kwargs=None):
+        """Call the listeners of matched nodes."""
+        kwargs = kwargs or {}
+        for node in nodes:
+            for callback, nargs, is_async in node.listeners:
+                res = callback(*args[:nargs - len(kwargs)], **kwargs)
+                if is_async or inspect.isawaitable(res):
+                    asyncio.ensure_future(res)
+
+    def emit(self, parts, args, kwargs=None):
+        """Call listeners matching event name parts."""
+        self.dispatch(self.match(parts), args, kwargs)
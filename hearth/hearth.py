@@ -12,6 +12,7 @@ import re
 import signal
 import schedule
 import uvloop
+from . import history
 
 
 asyncio.set_event_loop(uvloop.new_event_loop())
@@ -68,6 +69,7 @@ asyncio.get_event_loop().__class__.call_at_ = asyncio.get_event_loop().__class__
 asyncio.get_event_loop().__class__.call_at = _call_at_mp
 
 DEVICES = {}
+STARTUP_REPORT_DELAY = 10
 
 
 def parse_args():
@@ -126,6 +128,7 @@ def main():
     load_config_directory(os.path.abspath(args.directory))
     asyncio.ensure_future(schedule.run())
     loop = asyncio.get_event_loop()
+    loop.call_later(STARTUP_REPORT_DELAY, history.report_restore)
 
     def ask_exit(signame):
         """Signal handler."""
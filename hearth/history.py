@@ -0,0 +1,919 @@
+"""Device state history log."""
+from array import array
+import asyncio
+from bisect import bisect_left, bisect_right
+from collections import deque
+from copy import deepcopy
+from datetime import datetime, timedelta
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from . import codec
+
+LOGGER = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 1000
+FLUSH_SIZE = 20
+FLUSH_INTERVAL = 10
+KEYFRAME_INTERVAL = 100
+TIMEFORMAT = "%Y-%m-%d %H:%M:%S"
+SQLITE_DATABASE = None
+SQLITE_BATCH_INTERVAL = 0.25
+SQLITE_MAX_ROWID = 2 ** 63 - 1
+RESTORE_STATS = {"devices": 0, "seconds": 0.0}
+
+_MISSING = object()
+
+
+class HistoryLog:
+    """Segmented append-only history log.
+
+    Entries are written as JSON lines to numbered segment files. Each segment
+    starts with a full state keyframe, so the current state can be recovered
+    from the last segment alone. A snapshot of the last written state is kept
+    next to the segments, so startup does not need to parse any of them."""
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.segment = -1
+        self.segment_entries = 0
+        self.pending = []
+        self.state = {}
+        self.reading = 0
+        self._flush_handle = None
+
+    def segments(self):
+        """List segment indices on disk, oldest first."""
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(int(name.split('.')[0]) for name in os.listdir(self.path)
+                      if name.endswith('.jsonl'))
+
+    def exists(self):
+        """Check if there is any history on disk."""
+        return bool(self.segments())
+
+    def segment_filename(self, index):
+        """Get path to segment."""
+        return os.path.join(self.path, f"{index:06d}.jsonl")
+
+    def snapshot_filename(self):
+        """Get path to last state snapshot."""
+        return os.path.join(self.path, 'state.json')
+
+    def read_segment(self, index):
+        """Read all entries of a segment."""
+        entries = []
+        with open(self.segment_filename(index), 'rb') as ifile:
+            for line in ifile:
+                try:
+                    entries.append(codec.loads(line))
+                except ValueError:
+                    LOGGER.warning("Skipping corrupt history entry in %s",
+                                   self.segment_filename(index))
+        return entries
+
+    def read_committed(self):
+        """Read the entries on disk, oldest first. Pending entries are not
+        written while `reading` is set, so this can be done in an executor."""
+        return [entry for index in self.segments()
+                for entry in self.read_segment(index)], None
+
+    def unwritten(self, _written=None):
+        """Get the entries not yet written to disk."""
+        return [codec.loads(line) for _, line in self.pending]
+
+    def read(self):
+        """Read all entries, oldest first."""
+        entries, _ = self.read_committed()
+        return entries + self.unwritten()
+
+    def first_timestamp(self, index):
+        """Get timestamp of the first entry of a segment."""
+        with open(self.segment_filename(index), 'rb') as ifile:
+            return codec.loads(ifile.readline())[0]
+
+    def expired(self, cutoff):
+        """List segments that only hold entries older than `cutoff`."""
+        expired = []
+        segments = self.segments()
+        for index, next_index in zip(segments, segments[1:]):
+            try:
+                if self.first_timestamp(next_index) > cutoff:
+                    break
+            except ValueError:
+                break
+            expired.append(index)
+        return expired
+
+    def expiring(self, cutoff):
+        """Read the entries that `prune(cutoff, until)` removes, and `until`.
+        Can be done in an executor."""
+        expired = self.expired(cutoff)
+        return ([entry for index in expired for entry in self.read_segment(index)],
+                expired[-1] + 1 if expired else None)
+
+    def prune(self, cutoff, until=None):
+        """Remove segments that only hold entries older than `cutoff`, and
+        are numbered below `until`."""
+        for index in self.expired(cutoff):
+            if until is not None and index >= until:
+                break
+            os.remove(self.segment_filename(index))
+
+    def open(self):
+        """Open the log for appending and recover the last state from the
+        snapshot, or from the tail segment if there is no snapshot."""
+        try:
+            with open(self.snapshot_filename(), 'rb') as ifile:
+                snapshot = codec.loads(ifile.read())
+            self.segment = snapshot['segment']
+            self.segment_entries = snapshot['entries']
+            return snapshot['state']
+        except (OSError, ValueError, KeyError):
+            pass
+        state = {}
+        segments = self.segments()
+        if segments:
+            tail = self.read_segment(segments[-1])
+            for _, upd_state in tail:
+                state.update(upd_state)
+            self.segment = segments[-1]
+            self.segment_entries = len(tail)
+        return state
+
+    def append(self, entry, state):
+        """Queue entry for writing.
+
+        `state` is the full state after the entry was applied, and is written
+        in place of the entry when a new segment is started."""
+        if self.segment_entries == 0 or self.segment_entries >= self.segment_size:
+            self.segment += 1
+            self.segment_entries = 0
+            entry = [entry[0], state]
+        self.state = state
+        self.pending.append((self.segment, codec.dumpb(entry)))
+        self.segment_entries += 1
+        if len(self.pending) >= FLUSH_SIZE:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        """Write pending entries to disk."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self.pending:
+            return
+        if self.reading:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                FLUSH_INTERVAL, self.flush)
+            return
+        os.makedirs(self.path, exist_ok=True)
+        ofile = None
+        try:
+            for index, line in self.pending:
+                if ofile is None or ofile.name != self.segment_filename(index):
+                    if ofile is not None:
+                        ofile.close()
+                    ofile = open(self.segment_filename(index), 'ab')
+                ofile.write(line + b"\n")
+        finally:
+            if ofile is not None:
+                ofile.close()
+        self.pending = []
+        with open(self.snapshot_filename() + '.tmp', 'wb') as ofile:
+            ofile.write(codec.dumpb({"segment": self.segment,
+                                     "entries": self.segment_entries,
+                                     "state": self.state}))
+        os.replace(self.snapshot_filename() + '.tmp', self.snapshot_filename())
+
+    async def aflush(self):
+        """Write pending entries to disk, once no read is in progress."""
+        while self.reading:
+            await asyncio.sleep(0.1)
+        self.flush()
+
+
+class Retention:
+    """History retention policy.
+
+    Raw entries are kept for `raw`. Older entries are rolled up into buckets
+    for each `(resolution, keep)` tier in turn, and dropped after the last.
+    Set per class through `Device.retention`, or per device by assigning
+    `device.history.retention`."""
+
+    def __init__(self, raw=timedelta(hours=48),
+                 tiers=((timedelta(minutes=5), timedelta(days=7)),
+                        (timedelta(hours=1), timedelta(days=90)))):
+        self.raw = raw
+        self.tiers = tiers
+
+
+def _connect(database):
+    """Open history database.
+
+    The last value of each key is kept in a table of its own, so startup does
+    not depend on the size of the history. It is filled from the history when
+    first created."""
+    os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+    conn = sqlite3.connect(database)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS history "
+                 "(device TEXT, key TEXT, ts TEXT, value TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS history_idx ON history (device, key, ts)")
+    with conn:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'last_state'").fetchone():
+            conn.execute("CREATE TABLE last_state (device TEXT, key TEXT, value TEXT, "
+                         "PRIMARY KEY (device, key)) WITHOUT ROWID")
+            conn.execute("INSERT INTO last_state SELECT device, key, value FROM history "
+                         "WHERE rowid IN (SELECT MAX(rowid) FROM history GROUP BY device, key)")
+    return conn
+
+
+class SQLiteWriter(threading.Thread):
+    """Writer thread that commits queued statements in batches every
+    SQLITE_BATCH_INTERVAL seconds."""
+
+    def __init__(self, database):
+        super().__init__(name="hearth-history", daemon=True)
+        self.database = database
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.written = 0
+
+    def execute(self, sql, rows):
+        """Queue statement for execution with each of `rows`, and return its
+        sequence number."""
+        self.queued += 1
+        self.queue.put((self.queued, sql, rows))
+        return self.queued
+
+    def flush(self):
+        """Block until all queued statements are committed."""
+        done = threading.Event()
+        self.queue.put((None, None, done))
+        done.wait()
+
+    def run(self):
+        conn = _connect(self.database)
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + SQLITE_BATCH_INTERVAL
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with self.lock:
+                try:
+                    with conn:
+                        for _, sql, rows in batch:
+                            if sql is not None:
+                                conn.executemany(sql, rows)
+                except sqlite3.Error as e:  # pylint: disable=invalid-name
+                    LOGGER.error("Could not write history: %s", e)
+                self.written = max((seq for seq, sql, _ in batch if sql is not None),
+                                   default=self.written)
+            for sql, _, done in batch:
+                if sql is None:
+                    done.set()
+
+
+class SQLiteDatabase:
+    """Shared history database, with one writer thread."""
+
+    def __init__(self, database):
+        self.path = database
+        self.conn = _connect(database)
+        self.writer = SQLiteWriter(database)
+        self.writer.start()
+        self._last_states = None
+
+    def last_state(self, device):
+        """Get the last recorded state of a device.
+
+        The last states of all devices are read from the last_state table with
+        a single query on first use. Devices missing from that result are
+        queried individually."""
+        if self._last_states is None:
+            self._last_states = {}
+            for dev, key, value in self.conn.execute(
+                    "SELECT device, key, value FROM last_state"):
+                self._last_states.setdefault(dev, {})[key] = codec.loads(value)
+        if device in self._last_states:
+            return self._last_states.pop(device)
+        return {key: codec.loads(value) for key, value in self.conn.execute(
+            "SELECT key, value FROM last_state WHERE device = ?", (device,))}
+
+    def query(self, sql, args):
+        """Run query on a connection of its own, so it can be done from an
+        executor. Returns the rows and the sequence number of the last
+        statement written before them."""
+        conn = sqlite3.connect(self.path)
+        try:
+            with self.writer.lock:
+                return conn.execute(sql, args).fetchall(), self.writer.written
+        finally:
+            conn.close()
+
+
+_DATABASES = {}
+
+
+def report_restore():
+    """Log time spent restoring device states."""
+    LOGGER.info("Restored state of %d devices in %.1f ms", RESTORE_STATS["devices"],
+                RESTORE_STATS["seconds"] * 1000)
+
+
+def use_sqlite(database=".cache/history.sqlite"):
+    """Store device history in an SQLite database instead of JSONL segments.
+
+    Must be called before any devices are created."""
+    global SQLITE_DATABASE  # pylint: disable=global-statement
+    SQLITE_DATABASE = os.path.abspath(database)
+
+
+class SQLiteHistoryLog:
+    """History log stored in an SQLite database, one row per changed key."""
+
+    def __init__(self, path, database):
+        self.path = path
+        self.device = os.path.basename(path)
+        if database not in _DATABASES:
+            _DATABASES[database] = SQLiteDatabase(database)
+        self.database = _DATABASES[database]
+        self.pending = deque()
+        self.reading = 0
+
+    def exists(self):
+        """Check if there is any history in the database."""
+        rows, _ = self.database.query(
+            "SELECT 1 FROM history WHERE device = ? LIMIT 1", (self.device,))
+        return bool(rows)
+
+    def read_committed(self):
+        """Read the entries in the database, oldest first, and the sequence
+        number they are written up to. Can be done in an executor."""
+        rows, written = self.database.query(
+            "SELECT ts, key, value FROM history WHERE device = ? ORDER BY ts, rowid",
+            (self.device,))
+        entries = []
+        for timestamp, key, value in rows:
+            if not entries or entries[-1][0] != timestamp:
+                entries.append([timestamp, {}])
+            entries[-1][1][key] = codec.loads(value)
+        return entries, written
+
+    def unwritten(self, written):
+        """Get the entries queued after sequence number `written`."""
+        return [entry for seq, entry in self.pending if seq > written]
+
+    def read(self):
+        """Read all entries, oldest first."""
+        entries, written = self.read_committed()
+        return entries + self.unwritten(written)
+
+    def open(self):
+        """Recover the last state."""
+        return self.database.last_state(self.device)
+
+    def append(self, entry, _):
+        """Queue entry for writing."""
+        timestamp, delta = entry
+        writer = self.database.writer
+        if not self.reading:
+            while self.pending and self.pending[0][0] <= writer.written:
+                self.pending.popleft()
+        values = [(key, codec.dumps(value)) for key, value in delta.items()]
+        writer.execute(
+            "INSERT OR REPLACE INTO last_state (device, key, value) VALUES (?, ?, ?)",
+            [(self.device, key, value) for key, value in values])
+        self.pending.append((writer.execute(
+            "INSERT INTO history (device, key, ts, value) VALUES (?, ?, ?, ?)",
+            [(self.device, key, timestamp, value) for key, value in values]), entry))
+
+    def flush(self):
+        """Wait for queued entries to be written."""
+        self.database.writer.flush()
+
+    async def aflush(self):
+        """Wait for queued entries to be written, in an executor."""
+        await asyncio.get_event_loop().run_in_executor(None, self.flush)
+
+    def expiring(self, cutoff):
+        """Read the entries that `prune(cutoff, until)` removes, and `until`.
+        Can be done in an executor."""
+        rows, _ = self.database.query(
+            "SELECT MAX(rowid) FROM history WHERE device = ?", (self.device,))
+        until = rows[0][0]
+        if until is None:
+            return [], None
+        rows, _ = self.database.query(
+            "SELECT ts, key, value FROM history WHERE device = ? AND ts < ? AND rowid <= ? "
+            "AND rowid NOT IN (SELECT MAX(rowid) FROM history "
+            "WHERE device = ? AND rowid <= ? GROUP BY key) ORDER BY ts, rowid",
+            (self.device, cutoff, until, self.device, until))
+        entries = []
+        for timestamp, key, value in rows:
+            if not entries or entries[-1][0] != timestamp:
+                entries.append([timestamp, {}])
+            entries[-1][1][key] = codec.loads(value)
+        return entries, until
+
+    def prune(self, cutoff, until=None):
+        """Remove entries older than `cutoff`, except the last value of each
+        key, from the rows up to `until`."""
+        until = until if until is not None else SQLITE_MAX_ROWID
+        self.database.writer.execute(
+            "DELETE FROM history WHERE device = ? AND ts < ? AND rowid <= ? AND rowid NOT IN "
+            "(SELECT MAX(rowid) FROM history WHERE device = ? AND rowid <= ? GROUP BY key)",
+            [(self.device, cutoff, until, self.device, until)])
+
+
+def _sample(value):
+    """Create rollup aggregate from a single value."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {"min": value, "max": value, "mean": value, "last": value, "n": 1}
+    return {"last": value, "n": 1}
+
+
+def _merge(agg, later):
+    """Merge two rollup aggregates, `later` being the most recent."""
+    if 'mean' not in agg or 'mean' not in later:
+        return dict(later, n=agg['n'] + later['n'])
+    count = agg['n'] + later['n']
+    return {"min": min(agg['min'], later['min']),
+            "max": max(agg['max'], later['max']),
+            "mean": (agg['mean'] * agg['n'] + later['mean'] * later['n']) / count,
+            "last": later['last'],
+            "n": count}
+
+
+def _bucket(timestamp, resolution):
+    """Get start of the bucket containing `timestamp`."""
+    when = datetime.fromisoformat(timestamp).timestamp()
+    step = resolution.total_seconds()
+    return datetime.fromtimestamp(when // step * step).strftime(TIMEFORMAT)
+
+
+def _epoch(timestamp):
+    """Convert history timestamp to epoch seconds."""
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+def _timestamp(epoch):
+    """Convert epoch seconds to history timestamp."""
+    return datetime.fromtimestamp(epoch).strftime(TIMEFORMAT)
+
+
+class Series:
+    """Numeric time series of a single state key.
+
+    Epoch timestamps and values are stored in flat arrays, 16 bytes per
+    sample. Values that are not numbers are stored as NaN."""
+
+    def __init__(self):
+        self.times = array('d')
+        self.values = array('d')
+        self.rolled_until = 0.0
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, when, value):
+        """Append sample."""
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = float('nan')
+        self.times.append(when)
+        self.values.append(value)
+
+    def range(self, start=None, end=None):
+        """Get (times, values) arrays of samples between `start` and `end`."""
+        low = bisect_left(self.times, start) if start is not None else 0
+        high = bisect_right(self.times, end) if end is not None else len(self.times)
+        return self.times[low:high], self.values[low:high]
+
+    def value_at(self, when):
+        """Get value at `when`, or None."""
+        index = bisect_right(self.times, when) - 1
+        if index < 0 or self.values[index] != self.values[index]:
+            return None
+        return self.values[index]
+
+    def prune(self, before):
+        """Remove and return (times, values) of samples up to `before`."""
+        index = bisect_right(self.times, before)
+        pruned = self.times[:index], self.values[:index]
+        del self.times[:index]
+        del self.values[:index]
+        return pruned
+
+
+class History:
+    """Delta-encoded device state history.
+
+    Each entry holds only the keys that changed. Every KEYFRAME_INTERVAL
+    entries a full copy of the state is kept, from which any past state can be
+    rebuilt. Entries older than the retention policy allows are rolled up into
+    coarser tiers of min/max/mean/last buckets.
+
+    Keys registered with `track` are kept out of the entries and stored in a
+    numeric `Series` each instead."""
+
+    def __init__(self, path, retention=None):
+        self.log = (SQLiteHistoryLog(path, SQLITE_DATABASE) if SQLITE_DATABASE
+                    else HistoryLog(path))
+        self.retention = retention or Retention()
+        self.state = {}
+        self.entries = []
+        self.times = []
+        self.keyframes = []
+        self.keyframe_indices = []
+        self.rollups = [[] for _ in self.retention.tiers]
+        self.rolled_until = ''
+        self.series = {}
+        self.series_rolled_until = {}
+        self.updates = 0
+        self.loaded = False
+        self.rollups_loaded = False
+        self.pruning = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rollups_filename(self):
+        """Get path to rollup tiers."""
+        return os.path.join(self.log.path, 'rollups.json')
+
+    def load(self):
+        """Restore and return the last recorded state.
+
+        The full history is only read from the log on first access."""
+        started = time.monotonic()
+        state = self.log.open()
+        self.state = deepcopy(state)
+        RESTORE_STATS["devices"] += 1
+        RESTORE_STATS["seconds"] += time.monotonic() - started
+        return state
+
+    def load_all(self):
+        """Read the full history from the log, unless already done."""
+        if self.loaded:
+            return
+        started = time.monotonic()
+        self._load(self.log.read(), started)
+
+    async def aload_all(self):
+        """Read the full history from the log in an executor, unless already
+        done. Entries not yet written are taken from memory."""
+        if self.loaded:
+            return
+        started = time.monotonic()
+        self.log.reading += 1
+        try:
+            entries, written = await asyncio.get_event_loop().run_in_executor(
+                None, self.log.read_committed)
+        finally:
+            self.log.reading -= 1
+        if not self.loaded:
+            self._load(entries + self.log.unwritten(written), started)
+
+    def _load(self, entries, started):
+        """Replace the history in memory with log entries."""
+        self.loaded = True
+        self.load_rollups()
+        self.state = {}
+        self.entries = []
+        self.times = []
+        self.keyframes = []
+        self.keyframe_indices = []
+        for key, series in self.series.items():
+            self.series[key] = Series()
+            self.series[key].rolled_until = series.rolled_until
+        for timestamp, upd_state in entries:
+            self._add(timestamp, upd_state)
+        self.prune()
+        LOGGER.info("Loaded history: %s, %d entries in %.1f ms", self.log.path,
+                    len(self.entries), (time.monotonic() - started) * 1000)
+
+    def flush(self):
+        """Write pending entries to disk."""
+        self.log.flush()
+
+    async def aflush(self):
+        """Write pending entries to disk, without blocking the event loop."""
+        await self.log.aflush()
+
+    def load_rollups(self):
+        """Read rollup tiers from disk, unless already done."""
+        if self.rollups_loaded:
+            return
+        self.rollups_loaded = True
+        if not os.path.exists(self.rollups_filename()):
+            return
+        with open(self.rollups_filename(), 'rb') as ifile:
+            rollups = codec.loads(ifile.read())
+        self.rolled_until = rollups['until']
+        self.rollups = rollups['tiers']
+        self.series_rolled_until = rollups.get('series_until', {})
+        for key, series in self.series.items():
+            series.rolled_until = self.series_rolled_until.get(key, 0.0)
+
+    def save_rollups(self):
+        """Write rollup tiers to disk."""
+        os.makedirs(self.log.path, exist_ok=True)
+        with open(self.rollups_filename(), 'wb') as ofile:
+            ofile.write(codec.dumpb({"until": self.rolled_until,
+                                     "series_until": {key: series.rolled_until
+                                                      for key, series in self.series.items()},
+                                     "tiers": self.rollups}))
+
+    def _rollup(self, tier, timestamp, aggregates):
+        """Fold aggregates into the bucket of `tier` containing `timestamp`."""
+        if tier >= len(self.retention.tiers):
+            return
+        start = _bucket(timestamp, self.retention.tiers[tier][0])
+        buckets = self.rollups[tier]
+        index = len(buckets)
+        while index > 0 and buckets[index - 1][0] > start:
+            index -= 1
+        if index == 0 or buckets[index - 1][0] != start:
+            buckets.insert(index, [start, {}])
+            index += 1
+        bucket = buckets[index - 1][1]
+        for key, agg in aggregates.items():
+            bucket[key] = _merge(bucket[key], agg) if key in bucket else agg
+
+    def prune(self, now=None):
+        """Roll up and drop entries that are past the retention policy."""
+        self.load_all()
+        now = now or datetime.now()
+        self._resize_tiers()
+        cutoff = (now - self.retention.raw).strftime(TIMEFORMAT)
+        kfi = bisect_right(self.keyframe_indices, bisect_right(self.times, cutoff)) - 1
+        if kfi > 0:
+            index = self.keyframe_indices[kfi]
+            for timestamp, delta in self.entries[:index]:
+                if timestamp > self.rolled_until:
+                    self._rollup(0, timestamp, {key: _sample(value)
+                                                for key, value in delta.items()})
+            self.rolled_until = max(self.rolled_until, self.times[index - 1])
+            del self.entries[:index]
+            del self.times[:index]
+            del self.keyframes[:kfi]
+            self.keyframe_indices = [kfindex - index for kfindex in self.keyframe_indices[kfi:]]
+        for key, series in self.series.items():
+            for when, value in zip(*series.prune(now.timestamp() - self.retention.raw.total_seconds())):
+                if when > series.rolled_until:
+                    self._rollup(0, _timestamp(when), {key: _sample(value)})
+                series.rolled_until = max(series.rolled_until, when)
+        self._expire_tiers(now)
+        self.log.prune((now - self.retention.raw).strftime(TIMEFORMAT))
+        if self.rolled_until or self.series:
+            self.save_rollups()
+
+    async def prune_log(self, now=None):
+        """Roll up and drop log entries that are past the retention policy,
+        reading only those entries, in an executor. The full history is left
+        unloaded."""
+        if self.pruning:
+            return
+        now = now or datetime.now()
+        cutoff = (now - self.retention.raw).strftime(TIMEFORMAT)
+        self.pruning = True
+        try:
+            expiring, until = await asyncio.get_event_loop().run_in_executor(
+                None, self.log.expiring, cutoff)
+        finally:
+            self.pruning = False
+        if self.loaded:
+            self.prune(now)
+            return
+        if self.log.reading:
+            return
+        self.load_rollups()
+        self._resize_tiers()
+        for timestamp, delta in expiring:
+            when = None
+            for key, value in delta.items():
+                series = self.series.get(key)
+                if series is None:
+                    if timestamp > self.rolled_until:
+                        self._rollup(0, timestamp, {key: _sample(value)})
+                    continue
+                when = when or _epoch(timestamp)
+                if when > series.rolled_until:
+                    self._rollup(0, timestamp, {key: _sample(value)})
+                    series.rolled_until = when
+            if len(delta) > len(delta.keys() & self.series.keys()):
+                self.rolled_until = max(self.rolled_until, timestamp)
+        self._expire_tiers(now)
+        if until is not None:
+            self.log.prune(cutoff, until)
+        if self.rolled_until or self.series:
+            self.save_rollups()
+
+    def _resize_tiers(self):
+        """Match rollup tiers to the retention policy."""
+        self.rollups += [[] for _ in self.retention.tiers[len(self.rollups):]]
+        del self.rollups[len(self.retention.tiers):]
+
+    def _expire_tiers(self, now):
+        """Fold buckets past the retention of their tier into the next."""
+        for tier, (_, keep) in enumerate(self.retention.tiers):
+            cutoff = (now - keep).strftime(TIMEFORMAT)
+            buckets = self.rollups[tier]
+            expired = bisect_right([start for start, _ in buckets], cutoff)
+            for start, aggregates in buckets[:expired]:
+                self._rollup(tier + 1, start, aggregates)
+            del buckets[:expired]
+
+    def track(self, *keys):
+        """Store numeric `keys` in a Series each, moving existing samples out
+        of the entries."""
+        for key in keys:
+            if key in self.series:
+                continue
+            series = self.series[key] = Series()
+            series.rolled_until = self.series_rolled_until.get(key, 0.0)
+            for timestamp, delta in self.entries if self.loaded else []:
+                if key in delta:
+                    series.append(_epoch(timestamp), delta.pop(key))
+
+    def _add(self, timestamp, upd_state):
+        """Add entry to memory and return the delta. Until the full history
+        is loaded, only the current state is kept."""
+        delta = {key: deepcopy(value) for key, value in upd_state.items()
+                 if key not in self.state or self.state[key] != value}
+        if not delta:
+            return None
+        if not self.loaded:
+            self.state.update(delta)
+            return delta
+        entry = {key: value for key, value in delta.items() if key not in self.series}
+        if entry and len(self.entries) % KEYFRAME_INTERVAL == 0:
+            self.keyframes.append(self.state.copy())
+            self.keyframe_indices.append(len(self.entries))
+        self.state.update(delta)
+        if len(entry) < len(delta):
+            when = _epoch(timestamp)
+            for key in delta.keys() & self.series.keys():
+                self.series[key].append(when, delta[key])
+        if entry:
+            self.entries.append([timestamp, entry])
+            self.times.append(timestamp)
+        return delta
+
+    def append(self, timestamp, upd_state):
+        """Record state update."""
+        delta = self._add(timestamp, upd_state)
+        if delta is not None:
+            self.log.append([timestamp, delta], self.state)
+            self.updates += 1
+            if self.updates % KEYFRAME_INTERVAL == 0:
+                if self.loaded:
+                    self.prune()
+                else:
+                    asyncio.ensure_future(self.prune_log())
+
+    def keyframe(self, index):
+        """Get (index, state) of the last keyframe at or before entry `index`."""
+        kfi = bisect_right(self.keyframe_indices, index) - 1
+        if kfi < 0:
+            return index, {}
+        return self.keyframe_indices[kfi], self.keyframes[kfi].copy()
+
+    def overlay(self, state, timestamp):
+        """Fill in tracked keys at `timestamp`."""
+        if self.series:
+            when = _epoch(timestamp)
+            for key, series in self.series.items():
+                value = series.value_at(when)
+                if value is not None:
+                    state[key] = value
+        return state
+
+    def history_range(self, start=None, end=None, keys=None):
+        """Get a lazy view of the history between `start` and `end`."""
+        self.load_all()
+        return HistoryView(self, start, end, keys)
+
+    def states(self, since=None):
+        """Iterate (timestamp, state) for all entries from `since`.
+
+        The yielded state is updated in place and must not be kept."""
+        return iter(self.history_range(since))
+
+    def state_at(self, timestamp):
+        """Rebuild the state at a given timestamp."""
+        return deepcopy(self.history_range(end=timestamp).last())
+
+    def changes(self, key, since=None):
+        """Iterate (timestamp, value) for each change of `key`, starting with
+        its value at `since`."""
+        return self.history_range(since).changes(key)
+
+
+class HistoryView:
+    """Lazy view of the history entries between two timestamps.
+
+    The range is located by binary search on the time index; iterating
+    replays at most one keyframe interval before the start of the view."""
+
+    def __init__(self, history, start=None, end=None, keys=None):
+        self.history = history
+        self.start = start
+        self.end = end
+        self.keys = keys
+        self.low = bisect_left(history.times, start) if start is not None else 0
+        self.high = (bisect_right(history.times, end) if end is not None
+                     else len(history.times))
+
+    def __len__(self):
+        return max(self.high - self.low, 0)
+
+    def _initial(self):
+        """Get the state just before the first entry of the view."""
+        entries = self.history.entries
+        index, state = self.history.keyframe(self.low)
+        for i in range(index, self.low):
+            state.update(entries[i][1])
+        return state
+
+    def _select(self, state, timestamp):
+        """Apply tracked keys and key selection to a state."""
+        state = self.history.overlay(state, timestamp)
+        if self.keys is None:
+            return state
+        return {key: state[key] for key in self.keys if key in state}
+
+    def __iter__(self):
+        """Iterate (timestamp, state) for each entry in the view.
+
+        Unless keys are selected, the yielded state is updated in place and
+        must not be kept."""
+        entries = self.history.entries
+        state = self._initial()
+        for i in range(self.low, self.high):
+            timestamp, delta = entries[i]
+            state.update(delta)
+            yield timestamp, self._select(state, timestamp)
+
+    def last(self):
+        """Get the state at the end of the view."""
+        state = self._initial()
+        entries = self.history.entries
+        for i in range(self.low, self.high):
+            state.update(entries[i][1])
+        timestamp = self.end or (self.history.times[-1] if self.history.times else None)
+        return self._select(state, timestamp) if timestamp else state
+
+    def series(self, key):
+        """Get (epoch times, values) arrays of tracked `key` within the view."""
+        return self.history.series[key].range(
+            _epoch(self.start) if self.start is not None else None,
+            _epoch(self.end) if self.end is not None else None)
+
+    def _series_changes(self, key):
+        """Iterate (timestamp, value) for each change of tracked `key`."""
+        series = self.history.series[key]
+        current = None
+        if self.start is not None:
+            current = series.value_at(_epoch(self.start))
+            if current is not None:
+                yield self.start, current
+        for when, value in zip(*self.series(key)):
+            if value == value and value != current:
+                current = value
+                yield _timestamp(when), value
+
+    def changes(self, key):
+        """Iterate (timestamp, value) for each change of `key`, starting with
+        its value at the start of the view."""
+        if key in self.history.series:
+            yield from self._series_changes(key)
+            return
+        entries = self.history.entries
+        current = self._initial().get(key, _MISSING)
+        if self.start is not None and current is not _MISSING:
+            yield self.start, current
+        for i in range(self.low, self.high):
+            timestamp, delta = entries[i]
+            if key in delta and delta[key] != current:
+                current = delta[key]
+                yield timestamp, current
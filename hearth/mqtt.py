@@ -1,46 +1,207 @@
 """MQTT Client class."""
 import asyncio
+from collections import OrderedDict
+from itertools import count
 import logging
-import json
+import time
 from asyncinit import asyncinit
 from amqtt.client import MQTTClient
+from . import codec
 
 LOGGER = logging.getLogger(__name__)
 
 SERVER = None
+SUBSCRIBE_WINDOW = 0.05
+SUBSCRIBE_CHUNK = 100
+COALESCE = ("zigbee2mqtt/+/set", "zigbee2mqtt/+/+/set")
+PUBLISH_RATE = 20
+PUBLISH_BURST = 10
+OUTBOX_SIZE = 1000
+INBOUND_WORKERS = 8
+INBOUND_HIGH_WATER = 500
+INBOUND_LAG_WARNING = 5
+BOOTSTRAP = ("zigbee2mqtt/+", "stat/+/POWER", "+/state")
+BOOTSTRAP_QUIET = 0.2
+BOOTSTRAP_TIMEOUT = 3
+BOOTSTRAP_GRACE = 60
+
+
+class Node:  # pylint: disable=too-few-public-methods
+    """Topic trie node."""
+    __slots__ = ('children', 'callbacks')
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = []
+
+
+class TopicTrie:
+    """Topic filters with callbacks, matched one topic level at a time.
+
+    Filters may use the MQTT wildcards `+`, matching one level, and `#`,
+    matching all remaining levels."""
+
+    def __init__(self):
+        self.root = Node()
+
+    def add(self, topic_filter, callback):
+        """Add callback for topic filter."""
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node.children.setdefault(level, Node())
+        node.callbacks.append(callback)
+
+    def match(self, topic):
+        """Get callbacks of all filters matching topic."""
+        callbacks = []
+        nodes = [self.root]
+        for depth, level in enumerate(topic.split('/')):
+            matched = []
+            for node in nodes:
+                if depth == 0 and level.startswith('$'):
+                    wildcards = ()
+                else:
+                    wildcards = ('+', '#')
+                for key in (level,) + wildcards:
+                    child = node.children.get(key)
+                    if child is None:
+                        continue
+                    if key == '#':
+                        callbacks.extend(child.callbacks)
+                    else:
+                        matched.append(child)
+            nodes = matched
+            if not nodes:
+                return callbacks
+        for node in nodes:
+            callbacks.extend(node.callbacks)
+            if '#' in node.children:
+                callbacks.extend(node.children['#'].callbacks)
+        return callbacks
+
+
+def encode(payload):
+    """Encode payload for publishing."""
+    if isinstance(payload, (dict, list)):
+        return codec.dumpb(payload)
+    if isinstance(payload, bytes):
+        return payload
+    return str(payload).encode()
 
 
 @asyncinit
 class ServerConnection:
-    """MQTT Client."""
+    """MQTT Client.
+
+    Messages are published in order from a single outbox, at most `rate` per
+    second with bursts of `burst`. While waiting, messages to topics matching
+    a `coalesce` filter replace earlier ones to the same topic, with dict
+    payloads merged, so only the latest command is sent.
 
-    async def __init__(self, uri="mqtt://localhost:1883"):
+    Received messages are handled by `workers` tasks, sharded by topic so
+    messages on one topic are handled in order. Reading from the broker waits
+    while a shard has `high_water` messages queued.
+
+    On connect, the `bootstrap` filters are subscribed to and retained
+    messages on them are collected in `retained`, so devices can take their
+    state from there instead of polling for it. The latest message per topic
+    is kept there for BOOTSTRAP_GRACE seconds, after which bootstrap filters
+    that no subscriber shares as `via` are unsubscribed from."""
+
+    async def __init__(self, uri="mqtt://localhost:1883", coalesce=COALESCE,  # pylint: disable=too-many-arguments
+                       rate=PUBLISH_RATE, burst=PUBLISH_BURST,
+                       workers=INBOUND_WORKERS, high_water=INBOUND_HIGH_WATER,
+                       bootstrap=BOOTSTRAP):
         if "://" not in uri:
             uri = "mqtt://" + uri
         self.uri = uri
-        self.subscriptions = {}
+        self.started = time.monotonic()
+        self.subscriptions = TopicTrie()
+        self.filters = {}
+        self._batch = None
+        self.coalesce = TopicTrie()
+        for topic_filter in coalesce:
+            self.coalesce.add(topic_filter, True)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.outbox = OrderedDict()
+        self.keys = count()
+        self.outbox_ready = asyncio.Event()
+        self.stats = {"published": 0, "coalesced": 0, "dropped": 0, "max_depth": 0}
+        self.lag = {"lag": 0.0, "max_lag": 0.0}
+        self.lagging = False
+        self.inbox = [asyncio.Queue(high_water) for _ in range(workers)]
+        self.throttled = False
+        self.retained = {}
+        self.collecting = False
+        self.last_retained = 0
+        self.subscribed = asyncio.Event()
+        self.used = set()
         self.mqtt = MQTTClient(config={"auto_reconnect": True})
         for key in logging.Logger.manager.loggerDict:
             if key.startswith("hbmqtt"):
                 logging.getLogger(key).setLevel(logging.WARNING)
         await self.mqtt.connect(self.uri)
+        self.filters.update({topic_filter: 0 for topic_filter in bootstrap})
         asyncio.ensure_future(self._loop())
+        asyncio.ensure_future(self._publisher())
+        for shard in self.inbox:
+            asyncio.ensure_future(self._worker(shard))
+        if bootstrap:
+            await self.bootstrap()
+            asyncio.ensure_future(self._end_bootstrap(bootstrap))
+
+    async def bootstrap(self):
+        """Collect retained messages on the subscribed bootstrap filters, until
+        none has arrived for BOOTSTRAP_QUIET seconds or for at most
+        BOOTSTRAP_TIMEOUT seconds."""
+        started = time.monotonic()
+        self.collecting = True
+        await self.subscribed.wait()
+        self.last_retained = time.monotonic()
+        while time.monotonic() - started < BOOTSTRAP_TIMEOUT:
+            await asyncio.sleep(BOOTSTRAP_QUIET)
+            if time.monotonic() - self.last_retained >= BOOTSTRAP_QUIET:
+                break
+        LOGGER.info("Collected %d retained messages in %.1f ms",
+                    len(self.retained), (time.monotonic() - started) * 1000)
+
+    async def _end_bootstrap(self, filters):
+        """Drop retained messages and unsubscribe from unused filters."""
+        await asyncio.sleep(BOOTSTRAP_GRACE)
+        self.collecting = False
+        self.retained.clear()
+        unused = [topic_filter for topic_filter in set(filters) if topic_filter not in self.used]
+        for topic_filter in unused:
+            self.filters.pop(topic_filter, None)
+        if unused:
+            try:
+                await self.mqtt.unsubscribe(unused)
+            except Exception as error:  # pylint: disable=broad-except
+                LOGGER.warning("Failed to unsubscribe from %s: %s", unused, error)
 
     async def _loop(self):
         """Connection handling loop."""
         while True:
             try:
-                if self.subscriptions:
-                    await self.mqtt.subscribe(
-                        [(t, qos)
-                         for t, (_, qos) in self.subscriptions.items()])
+                if self.filters:
+                    await self.subscribe(self.filters)
+                self.subscribed.set()
                 while True:
                     message = await self.mqtt.deliver_message()
                     topic = message.publish_packet.variable_header.topic_name
                     payload = message.publish_packet.payload.data.decode()
-                    callback = self.subscriptions.get(
-                        topic, (self.message_handler,))[0]
-                    asyncio.ensure_future(callback(topic, payload))
+                    if self.collecting and (message.publish_packet.retain_flag
+                                            or topic in self.retained):
+                        self.retained[topic] = payload
+                        self.last_retained = time.monotonic()
+                    shard = self.inbox[hash(topic) % len(self.inbox)]
+                    if shard.full() and not self.throttled:
+                        LOGGER.warning("MQTT inbound queue full, waiting: %s", topic)
+                    self.throttled = shard.full()
+                    await shard.put((time.monotonic(), topic, payload))
             except KeyboardInterrupt:
                 break
             except asyncio.CancelledError:
@@ -51,19 +212,122 @@ class ServerConnection:
             await self.mqtt.reconnect()
 
     async def pub(self, topic, payload, qos=0):
-        """Publish message on topic."""
-        if isinstance(payload, dict) or isinstance(payload, list):
-            payload = json.dumps(payload)
-        asyncio.ensure_future(self.mqtt.publish(topic, str(payload).encode(), qos))
+        """Queue message for publishing on topic."""
+        if self.coalesce.match(topic):
+            key = ('topic', topic)
+            if key in self.outbox:
+                _, pending, pending_qos = self.outbox[key]
+                if isinstance(pending, dict) and isinstance(payload, dict):
+                    payload = {**pending, **payload}
+                self.outbox[key] = (topic, payload, max(qos, pending_qos))
+                self.stats["coalesced"] += 1
+                return
+        else:
+            key = ('msg', next(self.keys))
+        if len(self.outbox) >= OUTBOX_SIZE:
+            self.stats["dropped"] += 1
+            LOGGER.warning("MQTT outbox full, dropping message on %s", topic)
+            return
+        self.outbox[key] = (topic, payload, qos)
+        self.stats["max_depth"] = max(self.stats["max_depth"], len(self.outbox))
+        self.outbox_ready.set()
+
+    def metrics(self):
+        """Outbox and inbound queue metrics, served by the web server at
+        /metrics. Lag is the time in seconds a received message waited before
+        being handled."""
+        return {"outbox": dict(self.stats, depth=len(self.outbox)),
+                "inbound": dict(self.lag, depth=sum(shard.qsize() for shard in self.inbox))}
+
+    async def _worker(self, shard):
+        """Handle received messages of a shard in order."""
+        while True:
+            received, topic, payload = await shard.get()
+            lag = time.monotonic() - received
+            self.lag["lag"] = lag
+            self.lag["max_lag"] = max(self.lag["max_lag"], lag)
+            if lag > INBOUND_LAG_WARNING and not self.lagging:
+                LOGGER.warning("MQTT inbound messages handled %.1f s late: %s", lag, topic)
+            self.lagging = lag > INBOUND_LAG_WARNING
+            for callback in self.subscriptions.match(topic) or [self.message_handler]:
+                try:
+                    await callback(topic, payload)
+                except Exception as error:  # pylint: disable=broad-except
+                    LOGGER.warning("MQTT handler failed on %s: %s", topic, error)
+
+    async def _take_token(self):
+        """Wait for the rate limit to allow a message."""
+        while self.rate:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def _publisher(self):
+        """Publish queued messages in order."""
+        while True:
+            await self.outbox_ready.wait()
+            self.outbox_ready.clear()
+            while self.outbox:
+                await self._take_token()
+                _, (topic, payload, qos) = self.outbox.popitem(last=False)
+                try:
+                    await self.mqtt.publish(topic, encode(payload), qos)
+                    self.stats["published"] += 1
+                except Exception as error:  # pylint: disable=broad-except
+                    LOGGER.warning("Failed to publish on %s: %s", topic, error)
+
+    async def sub(self, topic, callback, qos=0, via=None):
+        """Subscribe to topic, or topic filter, with callback.
+
+        `via` is a broader filter to subscribe to at the broker instead, which
+        other subscribers can share."""
+        self.subscriptions.add(topic, callback)
+        topic_filter = via or topic
+        self.used.add(topic_filter)
+        if self.filters.get(topic_filter, -1) >= qos:
+            return
+        self.filters[topic_filter] = qos
+        self.subscribe_later(topic_filter, qos)
+
+    def subscribe_later(self, topic_filter, qos):
+        """Queue filter for the next SUBSCRIBE, sent SUBSCRIBE_WINDOW after the
+        first filter is queued."""
+        if self._batch is None:
+            self._batch = {}
+            asyncio.get_event_loop().call_later(SUBSCRIBE_WINDOW, self._send_batch)
+        self._batch[topic_filter] = qos
+
+    def _send_batch(self):
+        """Send queued filters."""
+        filters, self._batch = self._batch, None
+
+        async def send():
+            """Subscribe, logging failures since no one awaits the result."""
+            try:
+                await self.subscribe(filters)
+            except Exception as error:  # pylint: disable=broad-except
+                LOGGER.warning("Failed to subscribe to %s: %s", list(filters), error)
+        asyncio.ensure_future(send())
 
-    async def sub(self, topic, callback, qos=0):
-        """Subscribe to topic with callback."""
-        self.subscriptions[topic] = (callback, qos)
-        await self.mqtt.subscribe([(topic, qos)])
+    async def subscribe(self, filters):
+        """Subscribe to topic filters at the broker, SUBSCRIBE_CHUNK per
+        SUBSCRIBE packet."""
+        started = time.monotonic()
+        filters = list(filters.items())
+        for index in range(0, len(filters), SUBSCRIBE_CHUNK):
+            await self.mqtt.subscribe(filters[index:index + SUBSCRIBE_CHUNK])
+        LOGGER.info("Subscribed to %d topic filters in %.1f ms, %.1f s after start",
+                    len(filters), (time.monotonic() - started) * 1000,
+                    time.monotonic() - self.started)
 
     async def message_handler(self, topic, payload):
-        """Default message handler."""
-        LOGGER.info("Message on unknown topic: %s : {%s}", topic, payload)
+        """Default message handler, for messages that only match a broader
+        `via` filter."""
+        LOGGER.debug("Message on unknown topic: %s : {%s}", topic, payload)
 
 
 async def server():
@@ -1,11 +1,24 @@
 """Hearth webserver"""
 import os
 import asyncio
-import json
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import functools
+from itertools import count
 import logging
+import time
 from sanic import Sanic, response
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from . import codec
 from . import hearth
+from . import mqtt
+from .assets import Assets
 from .hearth import D
+from .history import TIMEFORMAT
 
 LOGGER = logging.getLogger(__name__)
 THIS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -16,14 +29,250 @@ WEBROOT = ROOT_DIR + '/www'
 WEBSERVER = None
 # print("Name: ", __name__)
 WEBAPP = Sanic("hearth")
-WEBAPP.static("/static", WEBROOT)
+ASSETS = Assets(WEBROOT)
+IMMUTABLE = "public, max-age=31536000, immutable"
 SOCKETS = set()
+ALL = set()
+SUBSCRIBERS = {}
+SUBSCRIPTIONS = {}
+FRAME_INTERVAL = 0.05
+HIGH_WATER = 64
+SEND_TIMEOUT = 10
+MAX_HANDLERS = 8
+HANDLER_TIMEOUT = 30
+MSGPACK = 'hearth.msgpack'
+SUBPROTOCOLS = ([MSGPACK] if msgpack else []) + ['hearth.json']
+ETAG_EPOCH = int(time.time())
+DIRTY = {}
+_FRAME = None
+
+
+def devices_message(devices, binary=False):
+    """Message with device snapshots, as MessagePack if `binary`."""
+    if binary:
+        return msgpack.packb({"m": "devices", "devices": [device.snapshot() for device in devices],
+                              "id": 0})
+    snapshots = ", ".join(device.snapshot_json() for device in devices)
+    return f'{{"m": "devices", "devices": [{snapshots}], "id": 0}}'
+
+
+def encode(message, binary=False):
+    """Encode message, as MessagePack if `binary`."""
+    return msgpack.packb(message) if binary else codec.dumps(message)
+
+
+@functools.lru_cache(maxsize=256)
+def packed(payload):
+    """MessagePack encoding of a payload only available as JSON."""
+    return msgpack.packb(codec.loads(payload))
+
+
+def unpack(raw):
+    """Decode incoming message, binary frames being MessagePack."""
+    if isinstance(raw, bytes) and msgpack:
+        return msgpack.unpackb(raw)
+    return codec.loads(raw)
+
+
+class Client:
+    """Websocket connection with a bounded outbound queue, drained by its own
+    writer task.
+
+    Incoming messages are handled concurrently, at most MAX_HANDLERS at a
+    time, while messages to the same device are handled in order."""
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.binary = getattr(socket, 'subprotocol', None) == MSGPACK
+        self.pending = OrderedDict()
+        self.messages = 0
+        self.closed = False
+        self.keys = count()
+        self.ready = asyncio.Event()
+        self.writer = asyncio.ensure_future(self.write())
+        self.handlers = asyncio.Semaphore(MAX_HANDLERS)
+        self.tails = {}
+
+    async def dispatch(self, device, data):
+        """Handle message in the background, after any earlier messages to the
+        same device. Waits while MAX_HANDLERS messages are in progress."""
+        await self.handlers.acquire()
+        task = asyncio.ensure_future(self.handle(device, data, self.tails.get(device.id)))
+        self.tails[device.id] = task
+
+        def done(_):
+            """Release handler slot."""
+            self.handlers.release()
+            if self.tails.get(device.id) is task:
+                del self.tails[device.id]
+        task.add_done_callback(done)
+
+    async def handle(self, device, data, previous=None):
+        """Handle message, reporting failures back to the client."""
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await asyncio.wait_for(device.webhandler(data, self), HANDLER_TIMEOUT)
+        except asyncio.TimeoutError:
+            LOGGER.warning("Handler timed out: %s", data)
+            self.error(data, "Timed out")
+        except Exception as error:  # pylint: disable=broad-except
+            LOGGER.warning("Handler failed: %s :: %s", data, error)
+            self.error(data, str(error) or type(error).__name__)
+
+    def error(self, data, message):
+        """Report failed message to the client."""
+        self.put({"id": data['id'], "m": "error", "request": data.get('m'),
+                  "ref": data.get('ref'), "error": message})
+
+    def put(self, payload, device=None):
+        """Queue payload: a message dict, an encoded message, or a function
+        encoding one for the given wire format when it is sent. A device
+        update replacing one still in the queue is turned into a snapshot of
+        the device, taken when it is sent.
+
+        Device updates are bounded by the number of devices, so only other
+        messages count towards HIGH_WATER. A client with more of them queued
+        is closed, and gets fresh snapshots when it reconnects."""
+        if self.closed:
+            return
+        if isinstance(payload, dict):
+            payload = encode(payload, self.binary)
+        if device is None:
+            self.pending[('msg', next(self.keys))] = payload
+            self.messages += 1
+            if self.messages > HIGH_WATER:
+                LOGGER.warning("Client fell behind, closing: %s", self.socket)
+                self.close()
+                asyncio.ensure_future(self.socket.close())
+                return
+        elif ('device', device.id) in self.pending:
+            self.pending[('device', device.id)] = functools.partial(devices_message, (device,))
+        else:
+            self.pending[('device', device.id)] = payload
+        self.ready.set()
+
+    async def send(self, payload):
+        """Queue payload, in place of sending it directly on the socket.
+        Functions are called right away, with the wire format."""
+        self.put(payload(self.binary) if callable(payload) else payload)
+
+    async def write(self):
+        """Send queued payloads. Clients that do not keep up are closed."""
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.pending:
+                (kind, _), payload = self.pending.popitem(last=False)
+                if kind == 'msg':
+                    self.messages -= 1
+                if callable(payload):
+                    payload = payload(self.binary)
+                elif self.binary and isinstance(payload, str):
+                    payload = packed(payload)
+                try:
+                    await asyncio.wait_for(self.socket.send(payload), SEND_TIMEOUT)
+                except asyncio.TimeoutError:
+                    LOGGER.warning("Send timed out, closing: %s", self.socket)
+                    self.closed = True
+                    self.pending.clear()
+                    await self.socket.close()
+                    return
+                except Exception as error:  # pylint: disable=broad-except
+                    LOGGER.debug("Send failed: %s", error)
+                    self.closed = True
+                    self.pending.clear()
+                    return
+
+    def close(self):
+        """Stop writer and drop queued payloads."""
+        self.closed = True
+        self.pending.clear()
+        self.messages = 0
+        self.writer.cancel()
+
+
+def asset_response(request, asset, immutable=False):
+    """Serve asset, compressed if the client accepts it."""
+    headers = {"ETag": f'"{asset.etag}"',
+               "Cache-Control": IMMUTABLE if immutable else "no-cache",
+               "Vary": "Accept-Encoding"}
+    if request.headers.get('if-none-match') == headers["ETag"]:
+        return response.empty(status=304, headers=headers)
+    body, encoding = asset.encoded(request.headers.get('accept-encoding', ''))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return response.raw(body, content_type=asset.content_type, headers=headers)
 
 
 @WEBAPP.route('/')
-async def index(_):
-    """Main page."""
-    return await response.file(WEBROOT + '/index.html')
+async def index(request):
+    """Main page, with fingerprinted asset URLs."""
+    return asset_response(request, ASSETS.get('index.html'))
+
+
+@WEBAPP.route('/static/<name:path>')
+async def static(request, name=''):
+    """Static asset. Requests fingerprinted with the current content hash
+    can be cached forever."""
+    asset = ASSETS.get(name)
+    if asset is None:
+        return response.text("Not found", status=404)
+    return asset_response(request, asset, request.args.get('v') == asset.etag)
+
+
+async def run(operation, socket=None):
+    """Run one {id, m, args} operation, returning its result or error."""
+    if not isinstance(operation, dict):
+        return {"error": "Invalid operation"}
+    device = D(operation.get('id'))
+    if not device:
+        return {"error": "No such recipient"}
+    if not device.handles(operation.get('m')):
+        return {"error": "No such method"}
+    try:
+        result = await device.webhandler(operation, socket)
+    except Exception as error:  # pylint: disable=broad-except
+        LOGGER.warning("Operation failed: %s :: %s", operation, error)
+        return {"error": str(error)}
+    try:
+        codec.dumps(result)
+    except TypeError:
+        result = repr(result)
+    return {"result": result}
+
+
+async def batch(operations, socket=None, ordered=False):
+    """Run operations, concurrently unless `ordered`, and return the result of
+    each."""
+    if ordered:
+        return [await run(operation, socket) for operation in operations]
+    return await asyncio.gather(*(run(operation, socket) for operation in operations))
+
+
+@WEBAPP.route('/b', methods=['POST'])
+async def batch_action(request):
+    """Run a batch of operations: a list of {id, m, args}, or {"ops": [...],
+    "ordered": true} to run them one at a time."""
+    try:
+        data = codec.loads(request.body)
+    except ValueError as error:
+        return response.json({"error": str(error)}, status=400, dumps=codec.dumps)
+    if isinstance(data, list):
+        data = {"ops": data}
+    if not isinstance(data, dict) or not isinstance(data.get('ops', []), list) \
+            or not all(isinstance(operation, dict) for operation in data.get('ops', [])):
+        return response.json({"error": "Expected a list of operations"}, status=400,
+                             dumps=codec.dumps)
+    results = await batch(data.get('ops', []), ordered=data.get('ordered', False))
+    return response.json({"results": results}, dumps=codec.dumps)
+
+
+@WEBAPP.route('/metrics')
+async def metrics(_):
+    """Runtime metrics, as JSON."""
+    return response.json({"mqtt": mqtt.SERVER.metrics() if mqtt.SERVER else None},
+                         dumps=codec.dumps)
 
 
 @WEBAPP.route('/a/<device:str>/<method:str>')
@@ -37,22 +286,71 @@ async def action(request, device='', method=''):
     device = D(data['id'])
     if not device:
         LOGGER.warning("No such recipient: '%s'", data['id'])
-        return response.json({"error": "No such recipient", "data": data}, status=404)
+        return response.json({"error": "No such recipient", "data": data}, status=404,
+                             dumps=codec.dumps)
 
     await device.webhandler(data, None)
-    return response.json(data)
+    return response.json(data, dumps=codec.dumps)
+
 
+def last_modified(device):
+    """HTTP date of the last device update."""
+    try:
+        seen = datetime.strptime(device.state.get('last_seen', ''), TIMEFORMAT)
+    except ValueError:
+        return None
+    return format_datetime(seen.astimezone(timezone.utc), usegmt=True)
+
+
+@WEBAPP.route('/h/<device:path>/<key:str>')
+async def plot(request, device='', key=''):
+    """Plot data of a device state. The window is given by `from` and `to`
+    timestamps, or by `hours` back from now, and thinned to `points`."""
+    device = D(device if device != "0" else 0)
+    if not device:
+        return response.json({"error": "No such device"}, status=404, dumps=codec.dumps)
+    headers = {"ETag": f'"{ETAG_EPOCH}-{device.state_version}"',
+               "Cache-Control": "no-cache"}
+    modified = last_modified(device)
+    if modified:
+        headers["Last-Modified"] = modified
+    if 'if-none-match' in request.headers:
+        if request.headers['if-none-match'] == headers["ETag"]:
+            return response.empty(status=304, headers=headers)
+    elif modified and request.headers.get('if-modified-since') == modified:
+        return response.empty(status=304, headers=headers)
 
-@WEBAPP.websocket('/ws')
+    start, end = request.args.get('from'), request.args.get('to')
+    try:
+        for timestamp in (start, end):
+            if timestamp is not None:
+                datetime.fromisoformat(timestamp)
+        if start is None:
+            hours = float(request.args.get('hours', 1))
+            start = (datetime.now() - timedelta(hours=hours)).strftime(TIMEFORMAT)
+        points = int(request.args.get('points', 0))
+        if points < 0:
+            raise ValueError("points must not be negative")
+    except (ValueError, OverflowError) as error:
+        return response.json({"error": f"Invalid plot arguments: {error}"}, status=400,
+                             dumps=codec.dumps)
+    await device.history.aload_all()
+    return response.json(device.plotdata(key, start, end, points or None),
+                         headers=headers, dumps=codec.dumps)
+
+
+@WEBAPP.websocket('/ws', subprotocols=SUBPROTOCOLS)
 async def wsocket(_, socket):
     """Websocket route."""
     global SOCKETS  # pylint: disable=global-statement
-    SOCKETS.add(socket)
+    client = Client(socket)
+    SOCKETS.add(client)
+    ALL.add(client)
     try:
         while True:
             try:
                 raw = await socket.recv()
-                data = json.loads(raw)
+                data = unpack(raw)
                 if 'id' not in data:
                     LOGGER.warning("Recipient not specified: %s", data)
                     continue
@@ -60,23 +358,127 @@ async def wsocket(_, socket):
                 if not device:
                     LOGGER.warning("No such recipient: '%s'", data['id'])
                     continue
-                await device.webhandler(data, socket)
-            except KeyError as error:
-                LOGGER.warning("Key not found: %s", error)
-            except json.JSONDecodeError as error:
-                LOGGER.warning("Invalid JSON data received: '%s' :: %s",
+                await client.dispatch(device, data)
+            except (ValueError, TypeError) as error:
+                LOGGER.warning("Invalid data received: '%s' :: %s",
                                raw, error)
     finally:
-        SOCKETS.remove(socket)
+        SOCKETS.remove(client)
+        unsubscribe(client, "all")
+        client.close()
 
 
 def broadcast(payload):
     """Send data to all websocket listeners."""
-    asyncio.ensure_future(asyncio.gather(*[s.send(payload) for s in SOCKETS]))
+    for client in SOCKETS:
+        client.put(payload)
+
+
+def expand(ids):
+    """Device ids, including the members of groups and rooms."""
+    expanded = set()
+    for id_ in ids:
+        device = D(id_)
+        if not device:
+            continue
+        expanded.add(id_)
+        members = device.__dict__.get('devices', ())
+        if isinstance(members, dict):
+            members = members.values()
+        expanded.update(expand(member.id for member in members))
+    return expanded
+
+
+def subscribers(id_):
+    """Sockets following a device."""
+    subscribed = SUBSCRIBERS.get(id_)
+    return ALL | subscribed if subscribed else ALL
+
+
+def subscribe(socket, ids):
+    """Follow devices, or all devices if `ids` is "all". Returns the ids that
+    were not followed before.
+
+    Subscribing to some devices while following all of them switches to
+    following only those."""
+    if socket in ALL:
+        if ids != "all":
+            ALL.discard(socket)
+            subscribe(socket, ids)
+        return set()
+    followed = SUBSCRIPTIONS.setdefault(socket, set())
+    if ids == "all":
+        new = set(hearth.DEVICES) - followed
+        unsubscribe(socket, "all")
+        ALL.add(socket)
+        return new
+    new = expand(ids) - followed
+    followed.update(new)
+    for id_ in new:
+        SUBSCRIBERS.setdefault(id_, set()).add(socket)
+    return new
+
+
+def unsubscribe(socket, ids):
+    """Stop following devices, or all devices if `ids` is "all"."""
+    if socket in ALL:
+        ALL.discard(socket)
+        if ids == "all":
+            return
+        subscribe(socket, set(hearth.DEVICES) - expand(ids))
+        return
+    followed = SUBSCRIPTIONS.get(socket, set())
+    for id_ in (set(followed) if ids == "all" else expand(ids) & followed):
+        followed.discard(id_)
+        SUBSCRIBERS[id_].discard(socket)
+        if not SUBSCRIBERS[id_]:
+            del SUBSCRIBERS[id_]
+    if not followed:
+        SUBSCRIPTIONS.pop(socket, None)
+
+
+def refresh(device):
+    """Mark device UI as dirty, to be broadcast with the next frame."""
+    global _FRAME  # pylint: disable=global-statement
+    DIRTY[device.id] = device
+    if _FRAME is None:
+        _FRAME = asyncio.get_event_loop().call_later(FRAME_INTERVAL, flush)
+
+
+def send(clients, message, device=None):
+    """Send message to some websocket listeners, encoded once per wire
+    format."""
+    payloads = {}
+    for client in clients:
+        if client.binary not in payloads:
+            payloads[client.binary] = encode(message, client.binary)
+        client.put(payloads[client.binary], device)
+
+
+def flush():
+    """Send a patch for each dirty device to its subscribers. Devices nobody
+    follows are not serialized at all."""
+    global _FRAME  # pylint: disable=global-statement
+    if _FRAME is not None:
+        _FRAME.cancel()
+        _FRAME = None
+    devices = list(DIRTY.values())
+    DIRTY.clear()
+    for device in devices:
+        clients = subscribers(device.id)
+        if not clients:
+            device.reset_snapshot()
+            continue
+        patch = device.patch()
+        if patch is not None:
+            LOGGER.info("Refreshing UI: %s", device.id)
+            send(clients, dict(patch, id=device.id), device)
+
 
 async def aserve(host="0.0.0.0", port=80):
     """Start webserver."""
     global WEBSERVER
+    await asyncio.get_event_loop().run_in_executor(None, ASSETS.preload)
     WEBSERVER = await WEBAPP.create_server(host=host, port=port, return_asyncio_server=True)
     await WEBSERVER.startup()
 
@@ -1,7 +1,6 @@
 """Zigbee server."""
-import json
 import logging
-from hearth import mqtt
+from hearth import codec, mqtt
 from .device import Device as DeviceBase
 
 LOGGER = logging.getLogger(__name__)
@@ -13,14 +12,21 @@ class Device(DeviceBase):
         await super().__init__(id_)
         self.mqtt = await mqtt.server()
         self.zbstates = []
-        await self.mqtt.sub(f"zigbee2mqtt/{self.id}", self.updatehandler)
-        await self.refresh()
+        topic = f"zigbee2mqtt/{self.id}"
+        await self.mqtt.sub(topic, self.updatehandler,
+                            via=None if '/' in self.id else "zigbee2mqtt/+")
+        retained = self.mqtt.retained.get(topic)
+        if retained is None:
+            await self.refresh()
+        else:
+            await self.updatehandler(topic, retained, set_seen=False)
 
-    async def updatehandler(self, _, payload):
-        """Handle updatemessage from MQTT."""
+    async def updatehandler(self, _, payload, set_seen=True):
+        """Handle updatemessage from MQTT. Retained messages are applied with
+        `set_seen` False, since they do not show the device is alive."""
         LOGGER.info("Getting zigbee update: %s :: %s", self.id, payload)
         try:
-            await self.update_state(json.loads(payload))
+            await self.update_state(codec.loads(payload), set_seen)
         except:
             LOGGER.warning("Failed to parse MQTT message: %s", payload)
 
@@ -2,6 +2,7 @@
 import React, { Component } from 'react'
 import ReactDOM from 'react-dom';
 import ReconnectingWebsocket from 'reconnecting-websocket';
+import { decode as msgpackDecode } from '@msgpack/msgpack';
 import { ThemeProvider, createMuiTheme } from '@mui/material/styles';
 import CssBaseline from '@mui/material/CssBaseline';
 import AppBar from '@mui/material/AppBar';
@@ -64,6 +65,10 @@ let DEVICES = {};
 let QUICK_ACTIONS = [];
 let HEARTH = null;
 let OPEN_DIALOG = null;
+// Binary MessagePack frames are smaller and faster to decode; add ?msgpack to
+// the URL to use them instead of plain JSON.
+const SUBPROTOCOLS = (new URLSearchParams(window.location.search).has('msgpack')
+    ? ['hearth.msgpack', 'hearth.json'] : ['hearth.json']);
 
 function open_dialog(e) {
     OPEN_DIALOG = this;
@@ -165,6 +170,19 @@ class DeviceHandler {
         this.props = dev
         this.component = null;
         this.state = dev.state;
+        this.v = dev.v;
+        this.resyncing = false;
+    }
+
+    reset(dev) {
+        this.props = dev;
+        this.state = dev.state;
+        this.v = dev.v;
+        this.resyncing = false;
+        if (this.component) {
+            this.component.setState(dev.state);
+            HEARTH.forceUpdate();
+        }
     }
 
     action(action) {
@@ -190,8 +208,34 @@ class DeviceHandler {
         HEARTH.send(payload);
     }
 
+    patch(data) {
+        if (data.v <= this.v || this.resyncing) {
+            return;
+        }
+        if (data.base !== this.v) {
+            this.resyncing = true;
+            HEARTH.get_devices([this.id]);
+            return;
+        }
+        this.v = data.v;
+        const state = Object.assign({}, data.state);
+        Object.entries(data.lists || {}).forEach(([key, s]) => {
+            const old = this.state[key] || [];
+            state[key] = old.slice(s.drop, old.length - s.trim).concat(s.append);
+        });
+        (data.remove || []).forEach(key => { state[key] = undefined; });
+        if ('ui' in data) {
+            this.props = Object.assign({}, this.props, {ui: data.ui, uiv: data.uiv});
+        }
+        this.setState(state);
+    }
+
     handle_message(data) {
-        if ('state' in data) {
+        if (data['m'] === 'patch') {
+            this.patch(data);
+        } else if (data['m'] === 'error') {
+            console.warn("Request failed: ", this.id, data['request'], data['error']);
+        } else if ('state' in data) {
             //console.log("Updating state: ", data['state']);
             this.setState(data['state']);
         }
@@ -236,6 +280,37 @@ class FilterHeader extends Component {
     }
 }
 
+class SourcedChart extends Component {
+    // Chart whose data is fetched from the history endpoint, and revalidated
+    // whenever the device version changes.
+    constructor(props) {
+        super(props);
+        this.state = {json: []};
+    }
+
+    componentDidMount() {
+        this.load();
+    }
+
+    componentDidUpdate(prevProps) {
+        if (prevProps.version !== this.props.version || prevProps.source !== this.props.source) {
+            this.load();
+        }
+    }
+
+    load() {
+        fetch(this.props.source, {cache: 'no-cache'})
+            .then(response => response.json())
+            .then(json => this.setState({json: json}));
+    }
+
+    render() {
+        const chart = this.props.chart;
+        const data = Object.assign({}, chart.data, {json: this.state.json});
+        return <C3Chart {...chart} data={data} />;
+    }
+}
+
 class DeviceDialog extends Component {
     componentWillMount() {
         this.handler = DEVICES[this.props.id];
@@ -309,6 +384,13 @@ class DeviceDialog extends Component {
                     c.props.axis["y"]["tick"]["format"] = d3format(c.props.axis["y"]["tick"]["formatstr"]);
                     console.log("Formatting: ", c.props.axis["y"]["tick"]["format"]);
                 }
+                if (c.source) {
+                    return <SourcedChart
+                        key={key}
+                        source={c.source}
+                        version={this.handler.v}
+                        chart={c.props} />;
+                }
                 return (
                     <C3Chart
                         key={key}
@@ -376,27 +458,40 @@ class Hearth extends Component {
         this.state = {active_panel: "quick", device_filter: null};
         this.ws = new ReconnectingWebsocket(
             'ws://' + window.location.hostname + ':' + window.location.port + '/ws',
+            SUBPROTOCOLS,
         );
+        this.ws.binaryType = 'arraybuffer';
         this.ws.addEventListener('open', event => { this.get_devices(); });
         this.ws.addEventListener('open', event => { this.get_quick_actions(); });
         this.ws.addEventListener('message', event => {
-            this.handle_message(JSON.parse(event.data));
+            this.handle_message(event.data instanceof ArrayBuffer
+                ? msgpackDecode(new Uint8Array(event.data))
+                : JSON.parse(event.data));
         });
     }
 
     handle_message(data) {
         if ('id' in data) {
-            if (data['id'] === 0) {
+            if (data['id'] === 0 && data['m'] === 'patch') {
+                if (0 in DEVICES) {
+                    DEVICES[0].handle_message(data);
+                }
+            } else if (data['id'] === 0) {
                 if ('m' in data) {
                     if (data['m'] == "devices") {
                         if ('devices' in data) {
                             data.devices.forEach(dev => {
-                                if (!(dev.id in DEVICES)) {
+                                if (dev.id in DEVICES) {
+                                    DEVICES[dev.id].reset(dev);
+                                } else {
                                     DEVICES[dev.id] = new DeviceHandler(dev);
                                 }
                             });
                         }
                     }
+                    if (data['m'] == "error") {
+                        console.warn("Request failed: ", data['request'], data['error']);
+                    }
                     if (data['m'] == "quick_actions") {
                         if ('quick_actions' in data) {
                             console.log(data["quick_actions"])
@@ -419,8 +514,20 @@ class Hearth extends Component {
         this.ws.send(JSON.stringify(data))
     }
 
-    get_devices() {
-        this.send({id: 0, m: "get_devices", devices: []})
+    get_devices(devices) {
+        this.send({id: 0, m: "get_devices", devices: devices || []})
+    }
+
+    subscribe(devices) {
+        this.send({id: 0, m: "subscribe", devices: devices || "all"})
+    }
+
+    unsubscribe(devices) {
+        this.send({id: 0, m: "unsubscribe", devices: devices || "all"})
+    }
+
+    batch(ops, ordered) {
+        this.send({id: 0, m: "batch", ops: ops, ordered: !!ordered})
     }
 
     get_quick_actions() {
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Benchmark the JSON work of handling one device message, per backend:
+decode an MQTT payload, log it to history, push a websocket patch and publish
+a command."""
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hearth import codec  # pylint: disable=wrong-import-position
+
+N = 100000
+PAYLOAD = (b'{"battery":97,"humidity":41.27,"linkquality":123,"pressure":1012.4,'
+           b'"temperature":21.56,"voltage":2995,"last_seen":"2024-01-01T12:00:00"}')
+PATCH = {"m": "patch", "base": 41, "v": 42, "id": "livingroom/climate",
+         "state": {"temperature": 21.56, "humidity": 41.27,
+                   "last_seen": "2024-01-01 12:00:00"}}
+COMMAND = {"state": "ON", "brightness": 254, "transition": 1}
+
+
+def process():
+    """JSON steps of handling one message."""
+    state = codec.loads(PAYLOAD.decode())
+    codec.dumpb(["2024-01-01 12:00:00", state])
+    codec.dumps(PATCH)
+    codec.dumpb(COMMAND)
+
+
+def main():
+    """Main."""
+    for backend in codec.available():
+        codec.use(backend)
+        seconds = timeit.timeit(process, number=N)
+        print(f"{backend:>8}: {N / seconds:12.0f} messages/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Benchmark event dispatch: inspect.signature per call vs cached arity."""
+import os
+import sys
+import asyncio
+import inspect
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hearth import Device  # pylint: disable=wrong-import-position
+
+N = 100000
+
+
+def event_signature(listeners, eventname, *args, **kwargs):
+    """Event dispatch as done before arity caching."""
+    for callback in listeners.get(eventname, []):
+        nargs = len(inspect.signature(callback).parameters) - len(kwargs)
+        res = callback(*args[:nargs], **kwargs)
+        if inspect.isawaitable(res):
+            asyncio.ensure_future(res)
+
+
+async def main():
+    """Main."""
+    device = await Device('bench')
+    raw = {}
+
+    def on_change(value, old_value, key):
+        """Listener."""
+
+    def on_any(device):
+        """Listener."""
+
+    for eventname, callback in (('statechange:temperature', on_change),
+                                ('statechange:temperature', on_any),
+                                ('statechange', on_any)):
+        device.listen(eventname, callback)
+        raw.setdefault(eventname, []).append(callback)
+
+    def before():
+        event_signature(raw, 'statechange:temperature', 21.0, 20.5, 'temperature', device)
+        event_signature(raw, 'statechange', device)
+
+    def after():
+        device.event('statechange:temperature', 21.0, 20.5, 'temperature', device)
+        device.event('statechange', device)
+
+    for name, fun in (("inspect.signature", before), ("cached arity", after)):
+        seconds = timeit.timeit(fun, number=N)
+        print(f"{name:>20}: {2 * N / seconds:12.0f} events/s")
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())